@@ -1,35 +1,122 @@
+import os
+import json
 import argparse
+import datetime
+import time
+import threading
 import requests
 import ast
 import pandas as pd
 import numpy as np
 import sqlalchemy
 from collections import Counter
-from flask import Flask, render_template, request
-from sqlalchemy import create_engine, MetaData, Table, and_
+from flask import Flask, render_template, request, jsonify
+from sqlalchemy import create_engine, MetaData, Table, and_, bindparam, func
 from sqlalchemy_utils import database_exists, create_database
-from sqlalchemy.sql.expression import cast
 import psycopg2
+from video_index import VideoIndex, MOOD_COLUMNS
+from response_cache import ResultCache, make_cache
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--database', '-d', help='Name of database to load', required=True)
+    parser.add_argument('--database', '-d', help='Name of database to load, or a SQLAlchemy URL', required=True)
     parser.add_argument('--table', '-t', help='Table of video information', required=True)
-    parser.add_argument('--user', '-u', help='Username for database connection', required=True)
-
-    return parser.parse_args()
+    parser.add_argument('--user', '-u', help='Username for database connection (unless --database is a URL)')
+    parser.add_argument('--pool-size', type=int, default=10, help='Database connections kept open')
+    parser.add_argument('--max-overflow', type=int, default=20, help='Extra connections allowed under load')
+    parser.add_argument('--memory-index', action='store_true', help='Answer requests from an in-memory copy of the video table')
+    parser.add_argument('--index-refresh', type=float, default=300, help='Seconds between reloads of the in-memory index (also reloaded on SIGHUP)')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Recommendation results cached in memory (0 to disable caching)')
+    parser.add_argument('--cache-ttl', type=float, default=300, help='Seconds a cached result is kept')
+    parser.add_argument('--cache-url', help='redis://host:port/db to share the result cache between app processes')
+    parser.add_argument('--cache-check', type=float, default=5, help='Seconds between checks for new scores from score_videos')
+    parser.add_argument('--tags-snapshot', help='JSON file of the topic list, read at startup if it is from the current scores and rebuilt otherwise')
+
+    return parser.parse_args(argv)
 
 ## Functions required to run app
-def load_db(dbname, username):
-    """ Creates a connection to my PostgreSQL database """
-    engine = create_engine('postgres://%s@localhost/%s'%(username,dbname))
+def load_db(dbname, username, pool_size=10, max_overflow=20):
+    """ Creates a connection pool to my PostgreSQL database, or to dbname if it is a SQLAlchemy URL """
+    if '://' in dbname:
+        url = dbname
+    else:
+        url = 'postgres://%s@localhost/%s'%(username,dbname)
+    if url.startswith('sqlite'):
+        # SQLite picks its own pool
+        engine = create_engine(url)
+    else:
+        engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
 
     if not database_exists(engine.url):
         create_database(engine.url)
 
-    connection = engine.connect()
-    
-    return engine, connection
+    return engine
+
+def reflect_videos(engine, table):
+    """ Reflect the video table once, for building queries on """
+    return sqlalchemy.Table(table, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+
+def reflect_postings(engine, table):
+    """ Reflect the tag -> video postings table score_videos keeps next to the video table, if there is one """
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, table + '_tags'):
+            return None
+
+    return sqlalchemy.Table(table + '_tags', sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+
+def build_tag_query(postings):
+    """ Which of some videos have any of some tags, both lists bound at execution """
+    return sqlalchemy.select([postings.columns.video_id]).where(and_(
+        postings.columns.tag.in_(bindparam('tags', expanding=True)),
+        postings.columns.video_id.in_(bindparam('ids', expanding=True)))).distinct()
+
+def get_tagged_videos(engine, tag_query, tags, ids):
+    """ Set of the ids that have any of the tags, looked up in the postings """
+    with engine.connect() as connection:
+        rows = connection.execute(tag_query, {'tags': list(tags), 'ids': list(ids)})
+        return set(row[0] for row in rows)
+
+class DateNumber(sqlalchemy.types.TypeDecorator):
+    """ A date bound as the YYYYMMDD integer that untyped upload dates are compared as """
+    impl = sqlalchemy.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(value.strftime('%Y%m%d'))
+
+def upload_date_filter(videos):
+    """ Upload date bounds, for DATE columns and for the YYYYMMDD text of tables not yet migrated """
+    upload_date = videos.columns.upload_date
+    if isinstance(upload_date.type, (sqlalchemy.Date, sqlalchemy.DateTime)):
+        return [upload_date > bindparam('min_upl'), upload_date < bindparam('max_upl')]
+
+    upload_date = sqlalchemy.cast(upload_date, sqlalchemy.Integer)
+    return [upload_date > bindparam('min_upl', type_=DateNumber()),
+            upload_date < bindparam('max_upl', type_=DateNumber())]
+
+def number_column(videos, name):
+    """ A numeric column, cast for the text columns of tables not yet migrated """
+    column = videos.columns[name]
+    if isinstance(column.type, (sqlalchemy.Integer, sqlalchemy.Numeric)):
+        return column
+
+    return sqlalchemy.cast(column, sqlalchemy.Integer)
+
+def build_mood_queries(videos):
+    """ Top 100 videos query for each mood, with the metadata ranges as bound parameters """
+    # typed, indexed columns (see scripts/video_schema.py) are compared as they are
+    duration = number_column(videos, 'duration')
+    view_count = number_column(videos, 'view_count')
+    meta_filter = [duration > bindparam('min_dur'),
+                   duration < bindparam('max_dur'),
+                   view_count > bindparam('min_vie'),
+                   view_count < bindparam('max_vie')] + upload_date_filter(videos)
+
+    queries = {}
+    for mood, column in MOOD_COLUMNS.items():
+        queries[mood] = sqlalchemy.select([videos]).where(and_(*meta_filter)).order_by(videos.columns[column].desc()).limit(100)
+
+    return queries
 
 def get_meta_params(meta):
     """ Parse the metadata selections for querying """
@@ -92,39 +179,32 @@ def get_meta_params(meta):
 
     return meta_new
 
-def get_top_videos(mood, engine, table, meta):
+def get_query_params(meta):
+    """ Bounds of the metadata selections, as bound to the mood queries """
+    meta_new = get_meta_params(meta)
+    params = {'min_dur': int(meta_new['duration'][0]),
+              'max_dur': int(meta_new['duration'][1]),
+              'min_vie': int(meta_new['views'][0]),
+              'max_vie': int(meta_new['views'][1]),
+              'min_upl': datetime.datetime.strptime(str(meta_new['upload'][0]), '%Y%m%d').date(),
+              'max_upl': datetime.datetime.strptime(str(meta_new['upload'][1]), '%Y%m%d').date()}
+
+    return params
+
+def get_top_videos(mood, engine, mood_queries, meta, index=None):
     """ Get the top ranking videos for a particular mood """
     
     # get selection parameters
-    meta_new = get_meta_params(meta)
-    min_dur = int(meta_new['duration'][0])
-    max_dur = int(meta_new['duration'][1])
-    min_vie = int(meta_new['views'][0])
-    max_vie = int(meta_new['views'][1])
-    min_upl = int(meta_new['upload'][0])
-    max_upl = int(meta_new['upload'][1])
-
-    # create a dataframe pulling all comment info from database for a video
-    videos = sqlalchemy.Table(table, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
-    meta_filter = [cast(videos.columns.duration,sqlalchemy.Integer) > min_dur, 
-                   cast(videos.columns.duration,sqlalchemy.Integer) < max_dur, 
-                   cast(videos.columns.view_count,sqlalchemy.Integer) > min_vie, 
-                   cast(videos.columns.view_count,sqlalchemy.Integer) < max_vie, 
-                   cast(videos.columns.upload_date,sqlalchemy.Integer) > min_upl, 
-                   cast(videos.columns.upload_date,sqlalchemy.Integer) < max_upl]
-
-    if mood == 'excited':
-        videos_query = sqlalchemy.select([videos]).where(and_(*meta_filter)).order_by(videos.columns.excited_score.desc()).limit(100)
-    elif mood == 'relaxed':
-        videos_query = sqlalchemy.select([videos]).where(and_(*meta_filter)).order_by(videos.columns.calm_score.desc()).limit(100)
-    elif mood == 'joking':
-        videos_query = sqlalchemy.select([videos]).where(and_(*meta_filter)).order_by(videos.columns.joke_score.desc()).limit(100)
-    elif mood == 'annoyed':
-        videos_query = sqlalchemy.select([videos]).where(and_(*meta_filter)).order_by(videos.columns.annoyed_score.desc()).limit(100)
-    else:
+    params = get_query_params(meta)
+
+    if index is not None:
+        return index.top_videos(mood, params)
+
+    if mood not in mood_queries:
         raise ValueError("Mood requested does not exist in database")
-        
-    videos_df = pd.read_sql(videos_query, engine)
+
+    # pull the top videos with a connection from the pool
+    videos_df = pd.read_sql(mood_queries[mood], engine, params=params)
     
     return videos_df
 
@@ -141,7 +221,7 @@ def get_vid_tags(tags):
 
     return [x[0] for x in tag_counts]
 
-def get_top_tags(engine, table, en_stop_words):
+def get_top_tags(engine, videos, en_stop_words, postings=None):
     """ Grab the top 20 common video tags """
     stop_words = set(en_stop_words +
                      ['buzzfeed', 'tasty', 'food',
@@ -151,19 +231,114 @@ def get_top_tags(engine, table, en_stop_words):
                      'best','anna', 'life', 'cook', 'bake',
                      'yolanda', 'olson', 'village', 'yummy',
                      'instant','pot','special'])
-    videos = sqlalchemy.Table(table, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
-    tag_query = sqlalchemy.select([videos.columns.tags])
-    tag_df = pd.read_sql(tag_query, engine)
+    if postings is not None:
+        # count videos per tag in the postings instead of parsing every video's tags
+        count = func.count().label('videos')
+        tag_query = sqlalchemy.select([postings.columns.tag, count]).group_by(postings.columns.tag) \
+            .order_by(count.desc(), postings.columns.tag).limit(100)
+        tags = pd.read_sql(tag_query, engine)['tag'].values
+    else:
+        tag_query = sqlalchemy.select([videos.columns.tags])
+        tag_df = pd.read_sql(tag_query, engine)
 
-    tag_df['top_tags'] = tag_df['tags'].apply(get_vid_tags)
-    tag_counts = pd.Series([x for y in tag_df['top_tags'].dropna() for x in y]).value_counts()
-    tags = tag_counts[:100].index.values
+        tag_df['top_tags'] = tag_df['tags'].apply(get_vid_tags)
+        tag_counts = pd.Series([x for y in tag_df['top_tags'].dropna() for x in y]).value_counts()
+        tags = tag_counts[:100].index.values
     tags = [x for x in tags if x not in stop_words]
 
     return tags[:20]
 
-def get_final_recs(df, tags):
-    """ After mood & tags are selected, return best recommendations """
+class TopTags(object):
+    """ The topic list shown on the index page, built in the background or read from a snapshot
+
+    version() is the data version of the video table. The snapshot keeps the
+    version it was built from, and is rebuilt once score_videos has written
+    new scores. A failed build is retried, waiting from retry_delay seconds
+    up to max_delay between tries.
+    """
+
+    def __init__(self, build, snapshot=None, version=lambda: 0, retry_delay=1.0, max_delay=60.0):
+        self.build = build
+        self.snapshot = snapshot
+        self.version = version
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.tags = []
+        self.ready = False
+
+    def start(self):
+        """ Use the snapshot if it is current, otherwise build the tags in a background thread """
+        if self.snapshot and os.path.exists(self.snapshot):
+            with open(self.snapshot) as f:
+                saved = json.load(f)
+            # snapshots from before versions were kept are a plain list
+            if isinstance(saved, dict) and saved.get('version') == self.version():
+                self.tags = saved['tags']
+                self.ready = True
+                return
+        thread = threading.Thread(target=self._build_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _build_loop(self):
+        delay = self.retry_delay
+        while not self._build():
+            # e.g. the database is down while the worker starts, /healthz stays 503 until it is back
+            print('Retrying the topic list in %.1f seconds' % delay)
+            time.sleep(delay)
+            delay = min(self.max_delay, delay * 2)
+
+    def _build(self):
+        """ Build the tags and write the snapshot, False if they could not be built """
+        try:
+            # the version before building, so scores written meanwhile rebuild it next time
+            version = self.version()
+            tags = [str(tag) for tag in self.build()]
+        except Exception as e:
+            print('Could not build the topic list: %s' % e)
+            return False
+        self.tags = tags
+        self.ready = True
+        if self.snapshot:
+            # written under another name first, so other workers never read half a file
+            partial = '%s.%d' % (self.snapshot, os.getpid())
+            with open(partial, 'w') as f:
+                json.dump({'version': version, 'tags': tags}, f)
+            os.rename(partial, self.snapshot)
+
+        return True
+
+def database_ready(engine):
+    """ Whether a pooled connection to the database works """
+    try:
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.text('SELECT 1'))
+    except sqlalchemy.exc.DBAPIError:
+        return False
+
+    return True
+
+def get_data_version(engine, table):
+    """ Version of the video table, which score_videos bumps after writing new scores """
+    query = sqlalchemy.text('SELECT version FROM data_versions WHERE name = :name')
+    try:
+        with engine.connect() as connection:
+            row = connection.execute(query, {'name': table}).fetchone()
+    except sqlalchemy.exc.DBAPIError:
+        # no scores written since versions were added
+        return 0
+
+    return row[0] if row is not None else 0
+
+def cache_key(mood, meta, tags):
+    """ Normalized request: the mood, the ranges the metadata selections map to, and sorted tags """
+    return (mood, tuple(sorted(get_meta_params(meta).items())), tuple(sorted(set(tags or []))))
+
+def get_final_recs(df, tags, tagged=None):
+    """ After mood & tags are selected, return best recommendations
+
+    tagged(tags, ids) returns the ids that have any of the tags, from the postings.
+    """
     
     if tags is None or tags == []:
         df_tags = df[:3]
@@ -172,8 +347,13 @@ def get_final_recs(df, tags):
         df_tags = df[:3]
         untagged = 'You selected anything as a topic, so we picked a few for you!'
     else:
-        df['top_tags'] = df['tags'].apply(get_vid_tags)
-        df_tags = df[ [bool(set(x) & set(tags)) for x in df['top_tags']] ][:3]
+        if tagged is not None:
+            df_tags = df[df['id'].isin(tagged(tags, df['id']))][:3]
+        else:
+            if 'top_tags' not in df.columns or not all(isinstance(x, list) for x in df['top_tags']):
+                # the in-memory index has them as lists already
+                df['top_tags'] = df['tags'].apply(get_vid_tags)
+            df_tags = df[ [bool(set(x) & set(tags)) for x in df['top_tags']] ][:3]
         untagged = 'We were able to find these videos matching your topics in this category!'
         if df_tags.empty:
             df_tags = df[:3]
@@ -183,50 +363,102 @@ def get_final_recs(df, tags):
     
 
 ## Initialize app
-app = Flask(__name__, static_url_path='/static')
-args = get_args()
-engine, connection = load_db(args.database, args.user)
-vid_table = args.table
+def create_app(args):
+    """ The Flask app for the options in args, see get_args
+
+    Nothing here reads the whole video table: the topic list and the
+    in-memory index are loaded in background threads, and /healthz answers
+    503 until they are ready. Servers with several worker processes call this
+    once per worker (wsgi.py).
+    """
+    app = Flask(__name__, static_url_path='/static')
+    engine = load_db(args.database, args.user, args.pool_size, args.max_overflow)
+    videos = reflect_videos(engine, args.table)
+    mood_queries = build_mood_queries(videos)
+    postings = reflect_postings(engine, args.table)
+
+    with open(os.path.join(app.root_path, 'data', 'stopwords.txt')) as sw:
+        en_stop_words = [line.strip() for line in sw]
+    top_tags = TopTags(lambda: get_top_tags(engine, videos, en_stop_words, postings), args.tags_snapshot,
+                       lambda: get_data_version(engine, args.table))
+    top_tags.start()
+
+    tagged = None
+    if postings is not None and not args.memory_index:
+        tag_query = build_tag_query(postings)
+        tagged = lambda tags, ids: get_tagged_videos(engine, tag_query, tags, ids)
+
+    video_index = None
+    if args.memory_index:
+        video_index = VideoIndex(engine, videos, top_tags=get_vid_tags)
+        video_index.start(args.index_refresh, wait=False)
+
+    response_cache = None
+    if args.cache_size > 0:
+        def data_version():
+            # an index refresh changes results as much as new scores do
+            return (get_data_version(engine, args.table), video_index.generation if video_index else 0)
+        response_cache = ResultCache(make_cache(args.cache_url, args.cache_size, args.cache_ttl),
+                                     data_version, args.cache_check)
+
+    def recommend(mood, meta, tags_sel):
+        """ (title, id, thumbnail) of the recommended videos, and the message about their tags """
+        # the database answers until the in-memory index has loaded
+        index = video_index if video_index is not None and video_index.ready else None
+        df = get_top_videos(mood, engine, mood_queries, meta, index)
+        df_final, untagged = get_final_recs(df, tags_sel, tagged)
 
-with open('data/stopwords.txt') as sw:
-    en_stop_words = [line.strip() for line in sw]
-tags = get_top_tags(engine, vid_table, en_stop_words)
+        vid_titles = df_final['title']
+        vid_urls = df_final['id']
+        vid_thumbs = df_final['thumbnail']
 
-## Render templates
+        return list(zip(vid_titles,vid_urls,vid_thumbs)), untagged
 
-@app.route('/', methods=['GET', 'POST'])
-def index(tags=tags):
-    return render_template('index.html', tags=tags)
+    ## Render templates
 
-@app.route('/recommended_videos', methods=['GET', 'POST'])
-def recommended_videos(engine=engine, vid_table=vid_table):
-    if 'taglist' in request.form.keys():
-        tags_sel = request.form.getlist('taglist')
-    else:
-        tags_sel = None
-    
-    meta = {}
+    @app.route('/', methods=['GET', 'POST'])
+    def index():
+        return render_template('index.html', tags=top_tags.tags)
 
-    if 'timelist' in request.form.keys():
-        meta['duration'] = request.form['timelist']
-    if 'viewlist' in request.form.keys():
-        meta['views'] = request.form['viewlist']
-    if 'uploadlist' in request.form.keys():
-        meta['upload'] = request.form['uploadlist']
-    if 'action' in request.form.keys():
-        mood = request.form['action'].lower()
+    @app.route('/recommended_videos', methods=['GET', 'POST'])
+    def recommended_videos():
+        if 'taglist' in request.form.keys():
+            tags_sel = request.form.getlist('taglist')
+        else:
+            tags_sel = None
+        
+        meta = {}
 
-        df = get_top_videos(mood, engine, vid_table, meta)
-        df_final, untagged = get_final_recs(df, tags_sel)
+        if 'timelist' in request.form.keys():
+            meta['duration'] = request.form['timelist']
+        if 'viewlist' in request.form.keys():
+            meta['views'] = request.form['viewlist']
+        if 'uploadlist' in request.form.keys():
+            meta['upload'] = request.form['uploadlist']
+        if 'action' in request.form.keys():
+            mood = request.form['action'].lower()
 
-        vid_titles = df_final['title']
-        vid_urls = df_final['id']
-        vid_thumbs = df_final['thumbnail']
+            if response_cache is not None:
+                vid_data, untagged = response_cache.get(cache_key(mood, meta, tags_sel),
+                                                        lambda: recommend(mood, meta, tags_sel))
+            else:
+                vid_data, untagged = recommend(mood, meta, tags_sel)
+
+        return render_template('recommended_videos.html', vid_data=vid_data, untagged=untagged)
+
+    @app.route('/healthz')
+    def healthz():
+        """ Readiness probe: 200 once the database answers and the startup loads are done """
+        checks = {'database': database_ready(engine), 'tags': top_tags.ready}
+        if video_index is not None:
+            checks['index'] = video_index.ready
+        status = 200 if all(checks.values()) else 503
 
-        vid_data = zip(vid_titles,vid_urls,vid_thumbs)
+        return jsonify(checks), status
 
-    return render_template('recommended_videos.html', vid_data=vid_data, untagged=untagged)
+    return app
 
 if __name__ == '__main__':
     #this runs your app locally
+    app = create_app(get_args())
     app.run(host='0.0.0.0', port=8080, debug=True)
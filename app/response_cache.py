@@ -0,0 +1,119 @@
+""" Cache of recommendation results, in process or in Redis, dropped when the scores change """
+
+from __future__ import print_function, division
+
+import time
+import pickle
+import threading
+from collections import OrderedDict
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class LRUCache(object):
+    """ In-process cache of at most maxsize entries, each kept for ttl seconds """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            # most recently used last
+            del self.entries[key]
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RedisCache(object):
+    """ Cache shared by app processes, in Redis or anything with the same get / set(ex=) calls """
+
+    def __init__(self, client, ttl=300, prefix='recs:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + repr(key))
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + repr(key), pickle.dumps(value), ex=int(self.ttl))
+
+    def clear(self):
+        # entries are keyed by data version, old ones just expire
+        pass
+
+def make_cache(url=None, maxsize=1024, ttl=300):
+    """ Cache backend for a URL: none or 'memory' for an LRUCache, redis://... for Redis """
+    if not url or url == 'memory':
+        return LRUCache(maxsize, ttl)
+    if url.startswith('redis://') or url.startswith('unix://'):
+        if redis is None:
+            raise ValueError('A Redis cache needs the redis package')
+        return RedisCache(redis.StrictRedis.from_url(url), ttl)
+
+    raise ValueError('Unknown cache URL: %s' % url)
+
+class ResultCache(object):
+    """ Results keyed by request and by the version of the data they were computed from
+
+    version() is checked at most every check_interval seconds. A new version
+    (e.g. score_videos wrote new scores) makes every cached result a miss.
+    """
+
+    def __init__(self, backend, version, check_interval=5.0):
+        self.backend = backend
+        self.version = version
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.current = None
+        self.checked = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def data_version(self):
+        now = time.time()
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return self.current
+            self.checked = now
+        current = self.version()
+        with self.lock:
+            if current != self.current:
+                self.current = current
+                self.backend.clear()
+            return current
+
+    def get(self, key, compute):
+        """ Cached result for key, computing and storing it on a miss """
+        key = (self.data_version(), key)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        self.backend.set(key, value)
+
+        return value
@@ -0,0 +1,134 @@
+""" In-memory index of the video table, answering top video queries without the database """
+
+from __future__ import print_function, division
+
+import signal
+import threading
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+MOOD_COLUMNS = {'excited': 'excited_score', 'relaxed': 'calm_score',
+                'joking': 'joke_score', 'annoyed': 'annoyed_score'}
+
+def parse_tag_array(text):
+    """ List of the tags in PostgreSQL array text such as {cake,"easy cake"} """
+    if not text or text == '{}':
+        return []
+
+    return [tag.strip('"').replace('\\\\', '\\') for tag in text[1:-1].split(',')]
+
+class IndexState(object):
+    """ One loaded copy of the table, replaced as a whole on refresh """
+
+    def __init__(self, df, top_tags=None):
+        self.df = df.reset_index(drop=True)
+        # NaN for missing values fails every comparison, as NULL does in SQL
+        self.duration = pd.to_numeric(self.df['duration'], errors='coerce').values.astype('float64')
+        self.views = pd.to_numeric(self.df['view_count'], errors='coerce').values.astype('float64')
+        upload = pd.to_datetime(self.df['upload_date'], errors='coerce').values.astype('datetime64[D]')
+        self.upload = np.where(np.isnat(upload), np.nan, upload.astype('int64'))
+        # rows of each mood ordered by score, highest first and missing scores last
+        self.orders = {}
+        for mood, column in MOOD_COLUMNS.items():
+            score = pd.to_numeric(self.df[column], errors='coerce').fillna(-np.inf).values
+            self.orders[mood] = np.argsort(-score, kind='mergesort')
+        if 'top_tags' in self.df.columns:
+            # normalized by score_videos already
+            self.df['top_tags'] = self.df['top_tags'].map(parse_tag_array)
+        elif top_tags is not None:
+            self.df['top_tags'] = self.df['tags'].map(lambda tags: top_tags(tags) if tags is not None else [])
+
+class VideoIndex(object):
+    """ The columns the recommender needs from the video table, held as NumPy arrays
+
+    top_videos walks a mood's precomputed ordering in chunks, checking the
+    metadata ranges with vectorized masks until it has enough rows. refresh()
+    reloads the table, and start() refreshes every `interval` seconds or on
+    SIGHUP.
+    """
+
+    columns = ['id', 'title', 'thumbnail', 'tags', 'duration', 'view_count', 'upload_date'] + \
+        sorted(MOOD_COLUMNS.values())
+
+    def __init__(self, engine, videos, top_tags=None, chunk=1024):
+        self.engine = engine
+        self.videos = videos
+        self.top_tags = top_tags
+        self.chunk = chunk
+        self.state = None
+        # counts refreshes, so cached results can tell which copy they came from
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def refresh(self):
+        """ Load the video table again and swap it in """
+        columns = self.columns + [c for c in ['top_tags'] if c in self.videos.columns]
+        query = sqlalchemy.select([self.videos.columns[c] for c in columns])
+        state = IndexState(pd.read_sql(query, self.engine), self.top_tags)
+        with self.lock:
+            self.state = state
+            self.generation += 1
+
+        return len(state.df)
+
+    @property
+    def ready(self):
+        return self.state is not None
+
+    def start(self, interval=300, wait=True):
+        """ Load, then refresh in the background every interval seconds or on SIGHUP
+
+        With wait=False the first load happens in the background too, and
+        ready stays False until it is done.
+        """
+        if wait:
+            self.refresh()
+        thread = threading.Thread(target=self._refresh_loop, args=(interval, not wait))
+        thread.daemon = True
+        thread.start()
+        try:
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.wake.set())
+        except (AttributeError, ValueError):
+            # no SIGHUP on Windows, and handlers can only be set from the main thread
+            pass
+
+    def _refresh_loop(self, interval, load_first=False):
+        if load_first:
+            self.wake.set()
+        while True:
+            self.wake.wait(interval or None)
+            self.wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Could not refresh the video index: %s' % e)
+
+    def top_videos(self, mood, params, limit=100):
+        """ Dataframe of the top `limit` videos for a mood within the ranges in params
+
+        params holds the same min_/max_ bounds as the app's SQL queries.
+        """
+        if mood not in MOOD_COLUMNS:
+            raise ValueError("Mood requested does not exist in database")
+        state = self.state
+        min_upl = np.datetime64(params['min_upl'], 'D').astype('int64')
+        max_upl = np.datetime64(params['max_upl'], 'D').astype('int64')
+
+        order = state.orders[mood]
+        found = []
+        count = 0
+        for start in range(0, len(order), self.chunk):
+            rows = order[start:start + self.chunk]
+            duration, views, upload = state.duration[rows], state.views[rows], state.upload[rows]
+            mask = ((duration > params['min_dur']) & (duration < params['max_dur']) &
+                    (views > params['min_vie']) & (views < params['max_vie']) &
+                    (upload > min_upl) & (upload < max_upl))
+            found.append(rows[mask])
+            count += len(found[-1])
+            if count >= limit:
+                break
+        rows = np.concatenate(found)[:limit] if found else np.zeros(0, dtype='int64')
+
+        return state.df.iloc[rows].reset_index(drop=True)
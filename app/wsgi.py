@@ -0,0 +1,15 @@
+""" WSGI entry point for running the app under a multi-process server
+
+    cd app && RECOMMENDER_ARGS="-d db -t videos -u user --tags-snapshot data/tags.json" \\
+        gunicorn -w 4 --threads 8 wsgi:application
+
+RECOMMENDER_ARGS holds the same options as running app.py directly. Each
+worker builds its own app, so don't start the server with --preload: the
+background loads would stay behind in the parent process.
+"""
+
+import os
+import shlex
+from app import create_app, get_args
+
+application = create_app(get_args(shlex.split(os.environ.get('RECOMMENDER_ARGS', ''))))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+""" Offline checks of the concurrent crawler against the stub YouTube server
+
+Two crawls run against scripts/stub_youtube_server.py on a local port:
+
+- rate: --videos videos on --workers threads sharing a --rate limiter. Every
+  video has to arrive complete, and no window of --window seconds may hold
+  more requests than the bucket allows (--burst plus --rate per second).
+- retry: one video while the stub answers the first --fail-first requests
+  with 503/429. The crawl has to retry through them, open the circuit breaker
+  once --breaker-threshold failures come in a row, and still get every
+  comment.
+
+Throughput of the rate crawl is printed. The script exits with an error
+listing any check that failed.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import download_comments
+from download_comments import RateLimiter, download_concurrent, make_session, save_comments
+from retry_policy import RetryPolicy, CircuitBreaker
+from comment_sinks import make_sink, Progress
+from stub_youtube_server import StubConfig, StubSession, serve
+
+def stub_config(args, **kwargs):
+    return StubConfig(pages=args.pages, per_page=args.per_page, latency=args.latency, retry_after=0, **kwargs)
+
+def comments_per_video(args):
+    """ Comments in one stub video, crawled in process """
+    session = StubSession(stub_config(args))
+
+    return sum(1 for _ in download_comments.download_comments('count', sleep=0, session=session))
+
+def busiest_window(times, window):
+    """ Most requests that arrived within any window seconds """
+    times = sorted(times)
+    busiest = 0
+    first = 0
+    for last, t in enumerate(times):
+        while t - times[first] > window:
+            first += 1
+        busiest = max(busiest, last - first + 1)
+
+    return busiest
+
+def check_rate(args, expected, workdir):
+    """ Crawl many videos concurrently, returns the failed checks """
+    config = stub_config(args)
+    server, base_url = serve(config=config)
+    sink = make_sink('jsonl', directory=os.path.join(workdir, 'rate'))
+    progress = Progress(interval=3600, stream=open(os.devnull, 'w'))
+    limiter = RateLimiter(args.rate, args.burst)
+    video_ids = ['video%d' % i for i in range(args.videos)]
+    start = time.time()
+    try:
+        download_concurrent(video_ids, args.workers, limiter, sink=sink, base_url=base_url,
+                            policy=RetryPolicy(max_retries=0), progress=progress)
+    finally:
+        sink.close()
+        server.shutdown()
+        server.server_close()
+    elapsed = time.time() - start
+
+    times = [t for t, _ in config.served]
+    busiest = busiest_window(times, args.window)
+    allowed = (args.burst or max(1, args.rate)) + args.rate * args.window
+    print('rate:  %d request(s) in %.2fs, %.1f requests/sec (limit %.1f), busiest %.1fs window %d (allowed %d)'
+          % (len(times), elapsed, len(times) / max(elapsed, 1e-9), args.rate, args.window, busiest, allowed))
+
+    failures = []
+    if progress.videos != args.videos or progress.comments != expected * args.videos:
+        failures.append('rate: got %d comment(s) from %d video(s), expected %d from %d'
+                        % (progress.comments, progress.videos, expected * args.videos, args.videos))
+    # one extra for the request that lands right on a window's edge
+    if busiest > allowed + 1:
+        failures.append('rate: %d requests within %.1fs, the limiter allows %d'
+                        % (busiest, args.window, allowed))
+
+    return failures
+
+def check_retry(args, expected, workdir):
+    """ Crawl one video through a burst of errors, returns the failed checks """
+    config = stub_config(args, fail_first=args.fail_first)
+    server, base_url = serve(config=config)
+    sink = make_sink('jsonl', directory=os.path.join(workdir, 'retry'))
+    breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown)
+    policy = RetryPolicy(max_retries=args.fail_first + 1, breaker=breaker)
+    try:
+        count = save_comments('retry', sink, session=make_session(), base_url=base_url, sleep=0, policy=policy)
+    except Exception as e:
+        return ['retry: the crawl failed: %s' % e]
+    finally:
+        sink.close()
+        server.shutdown()
+        server.server_close()
+
+    stats = policy.stats.snapshot()
+    retries = stats['retries']
+    print('retry: %d comment(s), retries %s' % (count, retries))
+
+    failures = []
+    if count != expected:
+        failures.append('retry: got %d comment(s), expected %d' % (count, expected))
+    if retries.get('server', 0) + retries.get('throttled', 0) != args.fail_first:
+        failures.append('retry: %d failed request(s) retried, the stub failed %d'
+                        % (retries.get('server', 0) + retries.get('throttled', 0), args.fail_first))
+    if args.fail_first >= args.breaker_threshold:
+        # the request after the threshold'th failure waits out the cooldown
+        gap = config.served[args.breaker_threshold][0] - config.served[args.breaker_threshold - 1][0]
+        if 'circuit_open' not in retries:
+            failures.append('retry: the breaker never opened after %d failures in a row' % args.fail_first)
+        elif gap < args.breaker_cooldown * 0.9:
+            failures.append('retry: requests resumed %.2fs after the breaker opened, cooldown is %.2fs'
+                            % (gap, args.breaker_cooldown))
+
+    return failures
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check crawler rate limiting and retries against the stub server')
+    parser.add_argument('--videos', type=int, default=8, help='Videos in the rate crawl')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='Download threads in the rate crawl')
+    parser.add_argument('--rate', '-r', type=float, default=20.0, help='Requests per second allowed')
+    parser.add_argument('--burst', type=int, help='Token bucket size (defaults to --rate)')
+    parser.add_argument('--window', type=float, default=1.0, help='Seconds per window the rate is checked over')
+    parser.add_argument('--pages', type=int, default=3, help='Pages of top level comments per video')
+    parser.add_argument('--per-page', type=int, default=20, help='Comments per page')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stub takes per response')
+    parser.add_argument('--fail-first', type=int, default=6, help='Requests the stub fails in the retry crawl')
+    parser.add_argument('--breaker-threshold', type=int, default=4, help='Failures in a row that open the breaker')
+    parser.add_argument('--breaker-cooldown', type=float, default=0.5, help='Seconds the breaker stays open')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    expected = comments_per_video(args)
+    workdir = tempfile.mkdtemp(prefix='bench_crawler_')
+    try:
+        failures = check_rate(args, expected, workdir) + check_retry(args, expected, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    if failures:
+        raise SystemExit('Crawler checks failed:\n  %s' % '\n  '.join(failures))
+    print('All crawler checks passed')
+
+if __name__ == '__main__':
+    main()
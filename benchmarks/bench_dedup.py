@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" Per-comment cost of download_comments as videos grow, against the old list de-duplication
+
+Pages come from the in-process stub session, so nothing touches the network.
+A linear crawl keeps roughly the same us/comment at every size.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import download_comments
+from stub_youtube_server import StubConfig, StubSession
+
+def crawl(n_pages, per_page):
+    """ Time one crawl of a video with n_pages pages, return (comments, seconds) """
+    session = StubSession(StubConfig(pages=n_pages, per_page=per_page, reply_every=0))
+    start = time.time()
+    count = sum(1 for _ in download_comments.download_comments('bench', sleep=0, session=session))
+    return count, time.time() - start
+
+def list_dedup(cids):
+    """ The old ret_cids list scan, for comparison """
+    start = time.time()
+    ret_cids = []
+    for cid in cids:
+        if cid not in ret_cids:
+            ret_cids.append(cid)
+    return time.time() - start
+
+def set_dedup(cids):
+    start = time.time()
+    ret_cids = set()
+    for cid in cids:
+        if cid not in ret_cids:
+            ret_cids.add(cid)
+    return time.time() - start
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark comment de-duplication in download_comments')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000],
+                        help='Comments per video to benchmark')
+    parser.add_argument('--per-page', type=int, default=100, help='Comments per page')
+    parser.add_argument('--list-max', type=int, default=20000,
+                        help='Largest size to run the quadratic list version on')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    print('%10s %16s %14s %14s' % ('comments', 'crawl us/com', 'set us/com', 'list us/com'))
+    for size in args.sizes:
+        count, elapsed = crawl(max(1, size // args.per_page), args.per_page)
+        cids = ['bench.%d' % i for i in range(count)]
+        list_cost = '-'
+        if size <= args.list_max:
+            list_cost = '%.3f' % (1e6 * list_dedup(cids) / count)
+        print('%10d %16.2f %14.3f %14s' % (count, 1e6 * elapsed / count,
+                                           1e6 * set_dedup(cids) / count, list_cost))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Pages/sec of the comment page extractor, before and after the single-pass rewrite
+
+Runs on every *.html file in --fixtures (e.g. saved all_comments pages or ajax
+html_content). Without --fixtures, pages are rendered by the stub server.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import download_comments
+from stub_youtube_server import StubConfig, render_page
+
+def legacy_extract(html):
+    """ The extractor as it was: two parses and six selectors built per page """
+    tree = lxml.html.fromstring(html)
+    item_sel = CSSSelector('.comment-item')
+    text_sel = CSSSelector('.comment-text-content')
+    time_sel = CSSSelector('.time')
+    author_sel = CSSSelector('.user-name')
+    lvote_sel = CSSSelector('.like-count')
+    dvote_sel = CSSSelector('.dislike-count')
+
+    comments = []
+    for item in item_sel(tree):
+        comments.append({'cid': item.get('data-cid'),
+                         'text': text_sel(item)[0].text_content(),
+                         'time': time_sel(item)[0].text_content().strip(),
+                         'author': author_sel(item)[0].text_content(),
+                         'clikes': lvote_sel(item)[0].text_content() if len(lvote_sel(item)) > 0 else 0,
+                         'cdislikes': dvote_sel(item)[0].text_content() if len(dvote_sel(item)) > 0 else 0})
+
+    tree = lxml.html.fromstring(html)
+    sel = CSSSelector('.comment-replies-header > .load-comments')
+    return comments, [i.get('data-cid') for i in sel(tree)]
+
+def load_pages(fixtures, n_pages, per_page):
+    if fixtures:
+        pages = []
+        for filename in sorted(glob.glob(os.path.join(fixtures, '*.html'))):
+            with open(filename, encoding='utf8') as fp:
+                pages.append(fp.read())
+        return pages
+
+    config = StubConfig(per_page=per_page)
+    return [render_page('bench%d' % i, 0, config) for i in range(n_pages)]
+
+def pages_per_sec(extract, pages, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for html in pages:
+            extract(html)
+    return repeat * len(pages) / (time.time() - start)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark comment extraction from HTML pages')
+    parser.add_argument('--fixtures', '-f', help='Directory of saved .html pages')
+    parser.add_argument('--pages', type=int, default=50, help='Stub pages to render without --fixtures')
+    parser.add_argument('--per-page', type=int, default=100, help='Comments per stub page')
+    parser.add_argument('--repeat', type=int, default=5, help='Passes over the pages')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    pages = load_pages(args.fixtures, args.pages, args.per_page)
+    if not pages:
+        sys.exit('No pages to benchmark')
+
+    expected = legacy_extract(pages[0])
+    for stream in (False, True):
+        if download_comments.extract_page(pages[0], stream) != expected:
+            sys.exit('Extractor output differs from the legacy one (stream=%s)' % stream)
+
+    baseline = pages_per_sec(legacy_extract, pages, args.repeat)
+    print('%-22s %10.1f pages/sec' % ('before (legacy)', baseline))
+    for name, stream in (('after (tree)', False), ('after (iterparse)', True)):
+        rate = pages_per_sec(lambda html: download_comments.extract_page(html, stream), pages, args.repeat)
+        print('%-22s %10.1f pages/sec  x%.2f' % (name, rate, rate / baseline))
+
+if __name__ == '__main__':
+    main()
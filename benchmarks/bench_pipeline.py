@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+""" Throughput of the whole pipeline on synthetic data, stage by stage
+
+download_comments crawls --videos videos from the in-process stub session into
+JSON lines, with youtube-dl info files written next to them. process_comments
+splits the comments into sets (and filters them by language with --lid-model).
+score_comments scores the sets with a stub model standing in for DeepMoji, and
+score_videos builds the video table, both against a SQLite file.
+
+Each stage runs in its own process. Its rows/sec, wall time and peak RSS are
+printed and written to --output as JSON, with the commit they were measured on.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+import sqlalchemy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'scripts'))
+
+import download_comments
+from comment_sinks import make_sink
+from stub_youtube_server import StubConfig, StubSession, WORDS
+
+class StubTokenizer(object):
+    """ Stands in for DeepMoji's SentenceTokenizer: word ids from the vocab, 0-padded to maxlen """
+
+    def __init__(self, vocab, maxlen):
+        self.vocab = vocab
+        self.maxlen = maxlen
+
+    def tokenize_sentences(self, texts):
+        tokens = np.zeros((len(texts), self.maxlen), dtype='uint16')
+        for i, text in enumerate(texts):
+            ids = [self.vocab.get(word, 1) for word in text.lower().split()[:self.maxlen]]
+            tokens[i, :len(ids)] = ids
+        return tokens, None, None
+
+class StubModel(object):
+    """ Stands in for DeepMoji: mood probabilities that depend only on the tokens """
+
+    input_shape = (None, None)
+
+    def __init__(self, n_moods=4, seed=0):
+        self.weights = np.random.RandomState(seed).randn(2 ** 16, n_moods)
+
+    def predict(self, tokens, batch_size=32):
+        logits = self.weights[tokens.astype('int64')].sum(axis=1)
+        prob = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return prob / prob.sum(axis=1, keepdims=True)
+
+def import_stub_scorer():
+    """ score_comments with the stub tokenizer and model, whether or not DeepMoji is installed """
+    for name in ['keras', 'examples', 'examples.example_helper', 'deepmoji',
+                 'deepmoji.sentence_tokenizer', 'deepmoji.attlayer']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules['deepmoji.sentence_tokenizer'].SentenceTokenizer = StubTokenizer
+    sys.modules['deepmoji.attlayer'].AttentionWeightedAverage = object
+    sys.modules['deepmoji'].attlayer = sys.modules['deepmoji.attlayer']
+
+    import score_comments
+    score_comments.SentenceTokenizer = StubTokenizer
+    score_comments.load_model = lambda path: StubModel(len(score_comments.MOODS))
+    try:
+        unicode
+    except NameError:
+        # score_comments is Python 2 code
+        score_comments.unicode = str
+
+    return score_comments
+
+def info_json(video_id, rng):
+    """ A youtube-dl info file's fields for a synthetic video """
+    return {'id': video_id,
+            'uploader': 'channel%d' % rng.randint(0, 50),
+            'uploader_id': 'UC%d' % rng.randint(0, 50),
+            'uploader_url': 'https://www.youtube.com/channel/x',
+            'channel_id': 'UC%d' % rng.randint(0, 50),
+            'channel_url': 'https://www.youtube.com/channel/x',
+            'upload_date': '%04d%02d%02d' % (rng.randint(2014, 2020), rng.randint(1, 13), rng.randint(1, 29)),
+            'title': ' '.join(rng.choice(WORDS) for _ in range(6)),
+            'thumbnail': 'https://i.ytimg.com/vi/%s/default.jpg' % video_id,
+            'description': ' '.join(rng.choice(WORDS) for _ in range(150)),
+            'categories': ['Howto & Style'],
+            'tags': [rng.choice(WORDS) for _ in range(rng.randint(0, 12))],
+            'duration': rng.randint(30, 4000),
+            'age_limit': 0,
+            'view_count': rng.randint(0, 10000000),
+            'like_count': rng.randint(0, 100000),
+            'dislike_count': rng.randint(0, 5000),
+            'average_rating': 5 * rng.random(),
+            # the rest of an info file, which score_videos reads past
+            'formats': [{'format_id': str(i), 'url': 'https://example.com/%d' % i} for i in range(20)]}
+
+def write_metadata(directory, video_ids, seed=0):
+    rng = random.Random(seed)
+    for video_id in video_ids:
+        with open(os.path.join(directory, video_id), 'w') as f:
+            json.dump(info_json(video_id, rng), f)
+
+def stage_download(work, args):
+    video_ids = ['vid%06d' % i for i in range(args.videos)]
+    with open(work['ids'], 'w') as f:
+        f.write(''.join(vid + '\n' for vid in video_ids))
+    write_metadata(work['meta'], video_ids)
+
+    session = StubSession(StubConfig(pages=args.pages, per_page=args.per_page))
+    sink = make_sink('jsonl', directory=work['comments'])
+    comments = 0
+    for video_id in video_ids:
+        comments += download_comments.save_comments(video_id, sink, session=session, sleep=0)
+    sink.close()
+
+    return comments
+
+def import_process_comments(args):
+    """ process_comments, whether or not fastText is installed when there is no language model to load """
+    if not args.lid_model:
+        try:
+            import fastText
+        except ImportError:
+            sys.modules['fastText'] = types.ModuleType('fastText')
+
+    import process_comments
+    return process_comments
+
+def stage_process(work, args):
+    process_comments = import_process_comments(args)
+    process_comments.get_comments(work['ids'], work['comments'], work['sets'], args.set_size)
+    if args.lid_model:
+        sets = sorted(f for f in os.listdir(work['sets']) if f.endswith('.csv'))
+        model = process_comments.fastText.load_model(args.lid_model)
+        process_comments.filter_lang(sets, 'en', model, work['sets'] + '/', outdir=work['scored_sets'])
+    sets = sorted(f for f in os.listdir(work['scored_sets']) if f.endswith('.csv'))
+    with open(work['set_list'], 'w') as f:
+        f.write(''.join(name + '\n' for name in sets))
+
+    return sum(len(process_comments.pd.read_csv(os.path.join(work['scored_sets'], name), index_col=0))
+               for name in sets)
+
+def stage_score_comments(work, args):
+    score_comments = import_stub_scorer()
+    with open(work['vocab'], 'w') as f:
+        json.dump(dict((word, i + 2) for i, word in enumerate(WORDS)), f)
+    sys.argv = ['score_comments.py', '--model', work['vocab'], '--vocab', work['vocab'],
+                '--database', work['db'], '--table', 'comments', '--comments', work['set_list'],
+                '--directory', os.path.join(work['scored_sets'], ''),
+                '--batch-size', str(args.batch_size)]
+    score_comments.main()
+
+    return table_rows(work['db'], 'comments')
+
+def stage_score_videos(work, args):
+    import score_videos
+    sys.argv = ['score_videos.py', '--database', work['db'], '--table', 'videos',
+                '--comments', 'comments', '--directory', work['meta'] + '/', '--settle', '0']
+    score_videos.main()
+
+    return table_rows(work['db'], 'videos')
+
+def table_rows(url, table):
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as connection:
+        return connection.execute(sqlalchemy.text('SELECT COUNT(*) FROM %s' % table)).scalar()
+
+# directories made in the work directory for the stages' files
+WORK_DIRS = ['comments', 'meta', 'sets', 'filtered']
+
+STAGES = [('download', stage_download), ('process', stage_process),
+          ('score_comments', stage_score_comments), ('score_videos', stage_score_videos)]
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def _run_stage(stage, work, args, results):
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        rows = stage(work, args)
+        results.put({'rows': int(rows), 'wall_sec': time.time() - start, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        results.put({'error': '%s: %s' % (type(e).__name__, e)})
+        raise
+
+def run_stage(stage, work, args):
+    """ Run one stage in a new process, for a peak RSS of its own """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage, args=(stage, work, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if 'error' in result:
+        raise SystemExit('Stage failed: %s' % result['error'])
+    result['rows_per_sec'] = result['rows'] / max(result['wall_sec'], 1e-9)
+
+    return result
+
+def remove_work(root, work, temporary):
+    """ Delete the generated files, and root too if it is the temporary directory """
+    if temporary:
+        shutil.rmtree(root)
+        return
+    for name in WORK_DIRS:
+        shutil.rmtree(work[name])
+    for name in ['ids', 'set_list', 'vocab']:
+        if os.path.exists(work[name]):
+            os.remove(work[name])
+    db_path = work['db'][len('sqlite:///'):]
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the pipeline on synthetic data')
+    parser.add_argument('--videos', '-n', type=int, default=200, help='Synthetic videos to crawl and score')
+    parser.add_argument('--pages', type=int, default=10, help='Comment pages per video')
+    parser.add_argument('--per-page', type=int, default=20, help='Top level comments per page (each fifth has 3 replies)')
+    parser.add_argument('--set-size', type=int, default=500, help='Comments per set, as process_comments --set-size')
+    parser.add_argument('--batch-size', type=int, default=1024, help='Comments per predict call, as score_comments --batch-size')
+    parser.add_argument('--lid-model', help='fastText language model; without one the language filter is skipped')
+    parser.add_argument('--workdir', help='Directory for the generated files (default: a temporary directory); '
+                                           'only the files the benchmark creates in it are deleted')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated files')
+    parser.add_argument('--output', '-o', default='pipeline_results.json', help='JSON file for the results')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the output of the stages')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    root = args.workdir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    work = dict((name, os.path.join(root, name)) for name in WORK_DIRS)
+    for directory in work.values():
+        os.makedirs(directory)
+    # score_comments reads the filtered sets when there is a language model to filter with
+    work.update(scored_sets=work['filtered'] if args.lid_model else work['sets'],
+                ids=os.path.join(root, 'ids.txt'), set_list=os.path.join(root, 'sets.txt'),
+                vocab=os.path.join(root, 'vocab.json'), db='sqlite:///' + os.path.join(root, 'pipeline.db'))
+
+    stages = {}
+    print('%-16s %10s %10s %12s %12s' % ('stage', 'rows', 'wall s', 'rows/sec', 'peak RSS MB'))
+    try:
+        for name, stage in STAGES:
+            stages[name] = result = run_stage(stage, work, args)
+            print('%-16s %10d %10.2f %12.1f %12.1f' % (name, result['rows'], result['wall_sec'],
+                                                       result['rows_per_sec'], result['peak_rss_mb']))
+    finally:
+        if not args.keep:
+            remove_work(root, work, temporary=not args.workdir)
+
+    results = {'commit': git_commit(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'config': dict((k, v) for k, v in vars(args).items() if k not in ('workdir', 'keep', 'output', 'verbose')),
+               'stages': stages,
+               'total_wall_sec': sum(result['wall_sec'] for result in stages.values())}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
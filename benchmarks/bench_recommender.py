@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+""" Load test of the recommender app: latency and throughput of / and /recommended_videos
+
+A synthetic video table with the columns score_videos writes (10k videos by
+default, any size up to 10M) is seeded into SQLite or PostgreSQL, then the app
+from create_app is driven through Flask's test client with a mix of moods,
+metadata selections and topics like the index page sends. Requests are made
+from --threads threads at once.
+
+p50/p95/p99 latency and requests/sec are printed, and --save writes them as
+JSON. Given a --baseline from an earlier run, the benchmark exits with an
+error when a percentile got more than --threshold slower.
+"""
+
+from __future__ import print_function, division
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import create_engine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'scripts'))
+sys.path.insert(0, os.path.join(HERE, '..', 'app'))
+
+import video_schema
+from bulk_loader import BulkLoader, has_table
+from bench_video_queries import synthetic_videos
+import app as recommender
+
+MOODS = ['Relaxed', 'Excited', 'Joking', 'Annoyed']
+DURATIONS = ['short', 'medium', 'long', 'any']
+VIEWS = ['undiscovered', 'average', 'popular', 'any']
+UPLOADS = ['recent', 'any']
+# tag words, a few common and most rare as in the scraped channels
+TAG_WORDS = ['cake', 'easy', 'chicken', 'pasta', 'vegan', 'healthy', 'dinner', 'bread', 'chocolate',
+             'soup', 'salad', 'keto', 'breakfast', 'cookies', 'holiday', 'quick', 'spicy', 'rice',
+             'pizza', 'burger', 'curry', 'noodles', 'dessert', 'lunch', 'snack', 'grill', 'fish',
+             'beef', 'pork', 'tofu', 'smoothie', 'pie', 'sandwich', 'tacos', 'sushi', 'ramen'] + \
+            ['word%d' % i for i in range(200)]
+
+def synthetic_tags(n, rng):
+    """ Array text of 2-8 tags per video, drawn with Zipf-like frequencies """
+    weights = 1.0 / np.arange(1, len(TAG_WORDS) + 1)
+    weights /= weights.sum()
+    counts = rng.randint(2, 9, n)
+    words = rng.choice(len(TAG_WORDS), counts.sum(), p=weights)
+    ends = np.cumsum(counts)
+
+    return ['{%s}' % ','.join('"%s"' % TAG_WORDS[w] for w in words[end - count:end])
+            for end, count in zip(ends, counts)]
+
+def seed(engine, table, n, chunksize=100000):
+    """ Fill table, its tag postings and its data version with n synthetic videos """
+    video_schema.video_table(table).drop(engine, checkfirst=True)
+    video_schema.tags_table(table + '_tags').drop(engine, checkfirst=True)
+    video_schema.video_table(table, indexes=False).create(engine)
+    loader = BulkLoader(engine, table, chunksize)
+
+    rng = np.random.RandomState(0)
+    for start in range(0, n, chunksize):
+        df = synthetic_videos(start, min(chunksize, n - start), rng)
+        df['tags'] = synthetic_tags(len(df), rng)
+        df['top_tags'] = df['tags'].map(video_schema.normalize_tags)
+        loader.add(df)
+        video_schema.load_tags(engine, table + '_tags', df, chunksize)
+        sys.stdout.write('Seeded %d videos\r' % min(n, start + chunksize))
+        sys.stdout.flush()
+    loader.close()
+    video_schema.create(engine, table)
+    video_schema.bump_version(engine, table)
+    print()
+
+def request_mix(n, topics, rng):
+    """ n (path, form) requests: a tenth index page loads, the rest recommendation forms """
+    requests = []
+    for _ in range(n):
+        if rng.rand() < 0.1:
+            requests.append(('/', None))
+            continue
+        form = {'action': MOODS[rng.randint(len(MOODS))]}
+        for field, options in (('timelist', DURATIONS), ('viewlist', VIEWS), ('uploadlist', UPLOADS)):
+            # most visitors leave a field unchecked
+            if rng.rand() < 0.4:
+                form[field] = options[rng.randint(len(options))]
+        pick = rng.rand()
+        if pick < 0.1:
+            form['taglist'] = ['anything']
+        elif pick < 0.7 and len(topics):
+            form['taglist'] = list(rng.choice(topics, min(len(topics), rng.randint(1, 4)), replace=False))
+        requests.append(('/recommended_videos', form))
+
+    return requests
+
+def run(app, requests, threads):
+    """ Latency in ms of each request, by path, and the wall time of the whole run """
+    local = threading.local()
+
+    def send(request):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        path, form = request
+        start = time.time()
+        if form is None:
+            response = local.client.get(path)
+        else:
+            response = local.client.post(path, data=form)
+        elapsed = 1000 * (time.time() - start)
+        if response.status_code != 200:
+            raise RuntimeError('%s answered %d' % (path, response.status_code))
+        return path, elapsed
+
+    start = time.time()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(send, requests))
+    wall = time.time() - start
+
+    times = {}
+    for path, elapsed in results:
+        times.setdefault(path, []).append(elapsed)
+        times.setdefault('all', []).append(elapsed)
+
+    return times, wall
+
+def summarize(times, wall):
+    results = {}
+    for path, values in sorted(times.items()):
+        values = np.array(values)
+        results[path] = {'requests': len(values),
+                         'p50_ms': float(np.percentile(values, 50)),
+                         'p95_ms': float(np.percentile(values, 95)),
+                         'p99_ms': float(np.percentile(values, 99))}
+    results['all']['requests_per_sec'] = len(times['all']) / wall
+
+    return results
+
+def regressions(results, baseline, threshold):
+    """ Messages for each percentile more than threshold slower than in baseline """
+    found = []
+    for path, stats in sorted(results.items()):
+        for name in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old = baseline.get(path, {}).get(name)
+            if old and stats[name] > old * (1 + threshold):
+                found.append('%s %s: %.1f ms, was %.1f ms' % (path, name, stats[name], old))
+    old = baseline.get('all', {}).get('requests_per_sec')
+    if old and results['all']['requests_per_sec'] < old / (1 + threshold):
+        found.append('requests/sec: %.1f, was %.1f' % (results['all']['requests_per_sec'], old))
+
+    return found
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Load test the recommender app')
+    parser.add_argument('--database', '-d', default='sqlite:///bench_recommender.db', help='SQLAlchemy URL to seed and serve from')
+    parser.add_argument('--table', '-t', default='bench_recs', help='Video table to seed')
+    parser.add_argument('--videos', '-n', type=int, default=10000, help='Synthetic videos in the table')
+    parser.add_argument('--reuse', action='store_true', help='Keep the table of an earlier run')
+    parser.add_argument('--requests', '-r', type=int, default=1000, help='Requests to send')
+    parser.add_argument('--warmup', type=int, default=50, help='Requests sent before timing starts')
+    parser.add_argument('--threads', type=int, default=4, help='Requests in flight at once')
+    parser.add_argument('--app-args', default='--cache-size 0', help='Extra options for the app, as on its command line')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Fail when a percentile is this much slower than the baseline')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    engine = create_engine(args.database)
+    if not (args.reuse and has_table(engine, args.table)):
+        seed(engine, args.table, args.videos)
+    engine.dispose()
+
+    app_args = recommender.get_args(['-d', args.database, '-t', args.table] + args.app_args.split())
+    app = recommender.create_app(app_args)
+    client = app.test_client()
+    started = time.time()
+    while client.get('/healthz').status_code != 200:
+        time.sleep(0.1)
+    print('App ready in %.1f s' % (time.time() - started))
+
+    # the topics the index page offers
+    page = client.get('/').data.decode('utf-8')
+    topics = [tag for tag in re.findall(r'name="taglist" value="([^"]*)"', page) if tag != 'anything']
+    rng = np.random.RandomState(1)
+    run(app, request_mix(args.warmup, topics, rng), args.threads)
+    times, wall = run(app, request_mix(args.requests, topics, rng), args.threads)
+    results = summarize(times, wall)
+
+    print('%-22s %9s %9s %9s %9s' % ('path', 'requests', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for path, stats in sorted(results.items()):
+        print('%-22s %9d %9.1f %9.1f %9.1f' % (path, stats['requests'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('%.1f requests/sec with %d thread(s)' % (results['all']['requests_per_sec'], args.threads))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        if found:
+            raise SystemExit('Slower than the baseline by more than %d%%:\n  %s'
+                             % (100 * args.threshold, '\n  '.join(found)))
+        print('Within %d%% of the baseline' % (100 * args.threshold))
+
+if __name__ == '__main__':
+    main()
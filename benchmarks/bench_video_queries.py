@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+""" Latency of the recommender's top-videos query on the typed, indexed video table
+against the old all-text table the app had to cast
+
+Both tables are filled with the same synthetic videos (1M by default), the
+query plans are printed with EXPLAIN (EXPLAIN ANALYZE on PostgreSQL), then
+each mood and filter combination is timed.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import datetime
+import argparse
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import create_engine, and_
+from sqlalchemy.sql.expression import cast
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import video_schema
+from bulk_loader import BulkLoader, has_table
+
+MOOD_COLUMNS = {'excited': 'excited_score', 'relaxed': 'calm_score',
+                'joking': 'joke_score', 'annoyed': 'annoyed_score'}
+
+# (duration, views, upload) ranges as get_meta_params returns them
+FILTERS = {'any': ((0, 4950), (0, 100000000), (20140101, 20191231)),
+           'short': ((0, 60), (0, 100000000), (20140101, 20191231)),
+           'popular': ((0, 4950), (1000000, 100000000), (20140101, 20191231)),
+           'recent long': ((600, 4950), (0, 100000000), (20180608, 20190608)),
+           'medium undiscovered': ((60, 600), (0, 100000), (20140101, 20191231))}
+
+def to_date(yyyymmdd):
+    return datetime.datetime.strptime(str(yyyymmdd), '%Y%m%d').date()
+
+def synthetic_videos(start, n, rng):
+    """ n videos with plausible durations, view counts, dates and mood scores """
+    scores = rng.dirichlet(np.ones(4), n)
+    first = datetime.date(2014, 1, 1).toordinal()
+    df = pd.DataFrame({'id': ['v%09d' % i for i in range(start, start + n)],
+                       'title': 'video',
+                       'thumbnail': 'https://i.ytimg.com/vi/x/default.jpg',
+                       'tags': '{"cake","easy","recipe"}',
+                       'duration': rng.randint(1, 4950, n),
+                       'view_count': rng.lognormal(10, 2.5, n).astype('int64'),
+                       'upload_date': [datetime.date.fromordinal(d) for d in rng.randint(first, first + 6 * 365, n)]})
+    for i, mood in enumerate(video_schema.MOODS):
+        df[mood + '_score'] = scores[:, i]
+
+    return df
+
+def build(engine, typed, text, n, chunksize=100000):
+    """ Fill the typed table and a text-only copy with n synthetic videos """
+    video_schema.video_table(typed).drop(engine, checkfirst=True)
+    sqlalchemy.Table(text, sqlalchemy.MetaData()).drop(engine, checkfirst=True)
+    typed_loader = BulkLoader(engine, typed, chunksize)
+    text_loader = BulkLoader(engine, text, chunksize)
+    # load the typed table first and index it afterwards, as migrate does
+    video_schema.video_table(typed, indexes=False).create(engine)
+
+    rng = np.random.RandomState(0)
+    for start in range(0, n, chunksize):
+        df = synthetic_videos(start, min(chunksize, n - start), rng)
+        typed_loader.add(df)
+        old = df.astype(str)
+        old['upload_date'] = [d.strftime('%Y%m%d') for d in df['upload_date']]
+        text_loader.add(old)
+        sys.stdout.write('Loaded %d videos\r' % min(n, start + chunksize))
+        sys.stdout.flush()
+    typed_loader.close()
+    text_loader.close()
+    video_schema.create(engine, typed)
+    print()
+
+def typed_query(videos, mood, meta):
+    (min_dur, max_dur), (min_vie, max_vie), (min_upl, max_upl) = meta
+    meta_filter = [videos.c.duration > min_dur, videos.c.duration < max_dur,
+                   videos.c.view_count > min_vie, videos.c.view_count < max_vie,
+                   videos.c.upload_date > to_date(min_upl), videos.c.upload_date < to_date(max_upl)]
+
+    return sqlalchemy.select([videos]).where(and_(*meta_filter)) \
+        .order_by(videos.c[MOOD_COLUMNS[mood]].desc()).limit(100)
+
+def text_query(videos, mood, meta):
+    """ The query as the app built it against text columns """
+    (min_dur, max_dur), (min_vie, max_vie), (min_upl, max_upl) = meta
+    meta_filter = [cast(videos.c.duration, sqlalchemy.Integer) > min_dur,
+                   cast(videos.c.duration, sqlalchemy.Integer) < max_dur,
+                   cast(videos.c.view_count, sqlalchemy.Integer) > min_vie,
+                   cast(videos.c.view_count, sqlalchemy.Integer) < max_vie,
+                   cast(videos.c.upload_date, sqlalchemy.Integer) > min_upl,
+                   cast(videos.c.upload_date, sqlalchemy.Integer) < max_upl]
+
+    return sqlalchemy.select([videos]).where(and_(*meta_filter)) \
+        .order_by(videos.c[MOOD_COLUMNS[mood]].desc()).limit(100)
+
+def explain(engine, query):
+    """ Plan lines of a query, EXPLAIN ANALYZE on PostgreSQL and EXPLAIN QUERY PLAN elsewhere """
+    compiled = query.compile(dialect=engine.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = 'EXPLAIN ANALYZE ' if engine.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN '
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + str(compiled), params)
+        return [' '.join(str(x) for x in row) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+def latencies(engine, query, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        pd.read_sql(query, engine)
+        times.append(1000 * (time.time() - start))
+
+    return np.array(times)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark top-video queries on typed and text video tables')
+    parser.add_argument('--database', '-d', default='sqlite:///bench_videos.db', help='SQLAlchemy URL to benchmark on')
+    parser.add_argument('--videos', '-n', type=int, default=1000000, help='Synthetic videos in each table')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='Runs of each query')
+    parser.add_argument('--reuse', action='store_true', help='Keep the tables of an earlier run with the same size')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    engine = create_engine(args.database)
+    typed_name, text_name = 'bench_videos', 'bench_videos_text'
+
+    if not (args.reuse and has_table(engine, typed_name) and has_table(engine, text_name)):
+        build(engine, typed_name, text_name, args.videos)
+    typed = sqlalchemy.Table(typed_name, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+    text = sqlalchemy.Table(text_name, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+
+    for name, table, make_query in (('text + casts', text, text_query), ('typed + indexes', typed, typed_query)):
+        print('Plan on %s (excited, any):' % name)
+        for line in explain(engine, make_query(table, 'excited', FILTERS['any'])):
+            print('    ' + line)
+
+    print('%-10s %-20s %14s %14s %8s' % ('mood', 'filter', 'text p50 ms', 'typed p50 ms', 'speedup'))
+    totals = {'text': [], 'typed': []}
+    for mood in sorted(MOOD_COLUMNS):
+        for filter_name in sorted(FILTERS):
+            meta = FILTERS[filter_name]
+            old = latencies(engine, text_query(text, mood, meta), args.repeat)
+            new = latencies(engine, typed_query(typed, mood, meta), args.repeat)
+            totals['text'].extend(old)
+            totals['typed'].extend(new)
+            print('%-10s %-20s %14.1f %14.1f %7.1fx'
+                  % (mood, filter_name, np.median(old), np.median(new), np.median(old) / np.median(new)))
+
+    for name in ('text', 'typed'):
+        times = np.array(totals[name])
+        print('%-6s p50 %8.1f ms  p95 %8.1f ms' % (name, np.percentile(times, 50), np.percentile(times, 95)))
+
+if __name__ == '__main__':
+    main()
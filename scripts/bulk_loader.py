@@ -0,0 +1,222 @@
+""" Bulk loading of DataFrames into the database """
+
+from __future__ import print_function, division
+
+import datetime
+import pandas as pd
+import sqlalchemy
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import instrument
+
+def db_url(dbname, username):
+    """ SQLAlchemy URL for my PostgreSQL database, or dbname itself if it is already a URL """
+    if '://' in dbname:
+        return dbname
+
+    return 'postgres://%s@localhost/%s' % (username, dbname)
+
+def array_literal(values):
+    """ PostgreSQL array text for a list, the form to_sql used to store list columns in """
+    return '{%s}' % ','.join('"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"') for v in values)
+
+def flatten_lists(df):
+    """ Copy of df with list cells (e.g. tags, categories) turned into array text """
+    list_columns = [c for c in df.columns
+                    if df[c].dtype == object and df[c].map(lambda x: isinstance(x, list)).any()]
+    if not list_columns:
+        return df
+    df = df.copy()
+    for c in list_columns:
+        df[c] = df[c].map(lambda x: array_literal(x) if isinstance(x, list) else x)
+
+    return df
+
+def has_table(engine, table):
+    with engine.connect() as connection:
+        return engine.dialect.has_table(connection, table)
+
+def ensure_column(engine, table, column, sql_type):
+    """ Add a nullable column to an existing table that doesn't have it yet """
+    if not has_table(engine, table):
+        return
+    columns = [c['name'] for c in sqlalchemy.inspect(engine).get_columns(table)]
+    if column not in columns:
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text('ALTER TABLE %s ADD COLUMN %s %s'
+                                               % (quote(table), quote(column), sql_type)))
+
+def create_once(engine, table, create):
+    """ Run create() to make table, unless another process made it at the same time
+
+    Loaders in parallel workers each create their table on their first write,
+    and all but one lose the race.
+    """
+    try:
+        create()
+    except sqlalchemy.exc.DBAPIError:
+        if not has_table(engine, table):
+            raise
+
+def delete_keys(connection, table, column, keys, chunksize=900):
+    """ Delete the rows of table whose column is in keys """
+    quote = connection.dialect.identifier_preparer.quote
+    query = sqlalchemy.text('DELETE FROM %s WHERE %s IN :keys' % (quote(table), quote(column)))
+    query = query.bindparams(sqlalchemy.bindparam('keys', expanding=True))
+    keys = list(keys)
+    for start in range(0, len(keys), chunksize):
+        connection.execute(query, {'keys': keys[start:start + chunksize]})
+
+def sources_table(name):
+    """ Table of the inputs (e.g. comment files) whose rows a loader has committed """
+    return sqlalchemy.Table(name, sqlalchemy.MetaData(),
+                            sqlalchemy.Column('source', sqlalchemy.Text, nullable=False),
+                            sqlalchemy.Column('loaded_at', sqlalchemy.DateTime))
+
+def loaded_sources(engine, name, sources, chunksize=900):
+    """ The sources recorded as loaded in the sources table name """
+    if not has_table(engine, name):
+        return set()
+    table = sources_table(name)
+    query = sqlalchemy.select([table.c.source]).where(table.c.source.in_(sqlalchemy.bindparam('sources', expanding=True)))
+    sources = list(sources)
+    loaded = set()
+    with engine.connect() as connection:
+        for start in range(0, len(sources), chunksize):
+            loaded.update(row[0] for row in connection.execute(query, {'sources': sources[start:start + chunksize]}))
+
+    return loaded
+
+class BulkLoader(object):
+    """ Buffers DataFrames and writes them to a table, batch_rows rows per transaction
+
+    PostgreSQL gets the rows as CSV through COPY FROM STDIN, other databases
+    (e.g. SQLite for local testing) get multi-row INSERTs. With a key column,
+    rows replace existing rows with the same key in the same transaction. With
+    a timestamp column, it is set to the UTC time each batch is written.
+    dtype maps columns to SQLAlchemy types for creating the table. With a
+    sources table, the source names given to add() are recorded there in the
+    same transaction as their rows, see loaded_sources.
+    """
+
+    def __init__(self, engine, table, batch_rows=50000, key=None, timestamp=None, dtype=None, sources=None):
+        self.engine = engine
+        self.table = table
+        self.batch_rows = batch_rows
+        self.key = key
+        self.timestamp = timestamp
+        self.dtype = dtype
+        self.sources_table = sources_table(sources) if sources else None
+        self.sources = []
+        self.pending = []
+        self.pending_rows = 0
+        self.callbacks = []
+        self.rows_written = 0
+        self.created = False
+
+    def add(self, df, callback=None, source=None):
+        """ Queue rows, writing them out once batch_rows are buffered
+
+        callback() is called once the rows are committed. source names where
+        the rows came from, for the sources table.
+        """
+        if callback is not None:
+            self.callbacks.append(callback)
+        if source is not None and self.sources_table is not None:
+            self.sources.append(source)
+        if len(df) == 0:
+            if not self.pending and not self.sources:
+                self._committed()
+            return
+        self.pending.append(df)
+        self.pending_rows += len(df)
+        if self.pending_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered rows in one transaction
+
+        If the write fails the rows and their callbacks stay queued, for the
+        next flush to retry or discard() to drop, and the error is raised.
+        """
+        if not self.pending and not self.sources:
+            return
+        df = flatten_lists(pd.concat(self.pending, ignore_index=True, sort=False)) if self.pending else None
+        if df is not None and self.timestamp:
+            df[self.timestamp] = datetime.datetime.utcnow()
+
+        if df is not None and not self.created:
+            # creates the table from the frame's columns if it doesn't exist yet
+            create_once(self.engine, self.table, lambda: df.head(0).to_sql(
+                self.table, con=self.engine, if_exists='append', index=False, dtype=self.dtype))
+            self.created = True
+        if self.sources:
+            create_once(self.engine, self.sources_table.name,
+                        lambda: self.sources_table.create(self.engine, checkfirst=True))
+
+        with instrument.timer('db_write'):
+            if self.engine.dialect.name == 'postgresql':
+                self._copy(df)
+            else:
+                self._insert(df)
+        rows = 0 if df is None else len(df)
+        self.pending = []
+        self.pending_rows = 0
+        self.sources = []
+        self.rows_written += rows
+        instrument.count('rows_written', rows)
+        self._committed()
+
+    def _committed(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def discard(self):
+        """ Drop the queued rows and their callbacks, e.g. after a failed flush """
+        self.pending = []
+        self.pending_rows = 0
+        self.sources = []
+        self.callbacks = []
+
+    def _source_rows(self):
+        now = datetime.datetime.utcnow()
+        return [{'source': source, 'loaded_at': now} for source in self.sources]
+
+    def _copy(self, df):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if df is not None:
+                buf = StringIO()
+                df.to_csv(buf, index=False, header=False)
+                buf.seek(0)
+                columns = ', '.join('"%s"' % c for c in df.columns)
+                if self.key:
+                    cursor.execute('DELETE FROM "%s" WHERE "%s" = ANY(%%s)' % (self.table, self.key),
+                                   (list(df[self.key].unique()),))
+                cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH (FORMAT csv)' % (self.table, columns), buf)
+            if self.sources:
+                cursor.executemany('INSERT INTO "%s" (source, loaded_at) VALUES (%%(source)s, %%(loaded_at)s)'
+                                   % self.sources_table.name, self._source_rows())
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _insert(self, df):
+        with self.engine.begin() as connection:
+            if df is not None:
+                # stay under SQLite's default limit of 999 bound parameters per statement
+                chunksize = max(1, 999 // max(1, len(df.columns)))
+                if self.key:
+                    delete_keys(connection, self.table, self.key, df[self.key].unique())
+                df.to_sql(self.table, con=connection, if_exists='append', index=False,
+                          method='multi', chunksize=chunksize)
+            if self.sources:
+                connection.execute(self.sources_table.insert(), self._source_rows())
+
+    def close(self):
+        self.flush()
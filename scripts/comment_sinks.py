@@ -0,0 +1,273 @@
+""" Output sinks for downloaded comments: batched, optionally compressed or columnar """
+
+from __future__ import print_function, division
+
+import os
+import sys
+import gzip
+import json
+import time
+import threading
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+COLUMNS = ['video_id', 'cid', 'text', 'time', 'author', 'clikes', 'cdislikes']
+
+def open_output(path, compression=None, append=False):
+    """ Binary file handle for path, compressed with gzip or zstd if asked """
+    mode = 'ab' if append else 'wb'
+    if compression is None:
+        return open(path, mode)
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.open(path, mode)
+
+    raise ValueError('Unknown compression: %s' % compression)
+
+def open_comments(path):
+    """ Text handle over a comments file written by any JSON lines sink """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('Reading %s needs the zstandard package' % path)
+        return zstandard.open(path, 'rt', encoding='utf8')
+
+    return open(path, encoding='utf8')
+
+class Progress(object):
+    """ Comment / video counts, printed on one line at most every `interval` seconds """
+
+    def __init__(self, interval=1.0, stream=sys.stdout):
+        self.interval = interval
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.comments = 0
+        self.videos = 0
+        self.start = time.time()
+        self.printed = 0.0
+
+    def add(self, comments=1, videos=0):
+        with self.lock:
+            self.comments += comments
+            self.videos += videos
+            now = time.time()
+            if now - self.printed >= self.interval:
+                self.printed = now
+                self.stream.write('Downloaded %d comment(s) from %d video(s), %.1f comments/sec\r'
+                                  % (self.comments, self.videos, self.comments / max(now - self.start, 1e-9)))
+                self.stream.flush()
+
+class Part(object):
+    """ One output file and the writers currently appending to it """
+
+    def __init__(self, path, handle):
+        self.path = path
+        self.handle = handle
+        self.assigned = 0
+        self.writers = 0
+        self.rows = []
+        self.callbacks = []
+
+class CommentWriter(object):
+    """ Collects one video's comments for a sink, see Sink.writer """
+
+    def __init__(self, sink, part, video_id):
+        self.sink = sink
+        self.part = part
+        self.video_id = video_id
+        self.rows = []
+
+    def write(self, comment):
+        self.rows.append(comment)
+        if len(self.rows) >= self.sink.batch_size:
+            self._write()
+
+    def _write(self):
+        if self.rows:
+            rows, self.rows = self.rows, []
+            self.sink.write_rows(self.part, self.video_id, rows)
+
+    def flush(self, callback=None):
+        """ Write out buffered comments, callback() runs once they are safely on disk """
+        self._write()
+        self.sink.flush_part(self.part, callback)
+
+    def close(self, callback=None):
+        self.flush(callback)
+        self.sink.video_done(self.part)
+
+class Sink(object):
+    """ Base for sinks writing one file per video, or one per `videos_per_file` videos
+
+    Subclasses provide the file format: open_part, write_rows, flush_part and close_part.
+    """
+
+    extension = ''
+
+    def __init__(self, directory='.', compression=None, batch_size=500, videos_per_file=0):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.compression = compression
+        self.batch_size = batch_size
+        self.videos_per_file = videos_per_file
+        self.lock = threading.Lock()
+        self.run_id = time.strftime('%Y%m%d%H%M%S')
+        self.parts = 0
+        self.current = None
+        self.open_parts = []
+
+    def writer(self, video_id, append=False):
+        """ CommentWriter for a video, append continues an earlier run's file """
+        with self.lock:
+            if not self.videos_per_file:
+                path = os.path.join(self.directory, video_id + '_comments' + self.extension)
+                part = self.open_part(path, append)
+                self.open_parts.append(part)
+            else:
+                if self.current is None or self.current.assigned >= self.videos_per_file:
+                    path = os.path.join(self.directory, 'comments_%s_%05d%s'
+                                        % (self.run_id, self.parts, self.extension))
+                    self.current = self.open_part(path, False)
+                    self.open_parts.append(self.current)
+                    self.parts += 1
+                part = self.current
+            part.assigned += 1
+            part.writers += 1
+
+        return CommentWriter(self, part, video_id)
+
+    def video_done(self, part):
+        with self.lock:
+            part.writers -= 1
+            if part.writers == 0 and part.assigned >= max(1, self.videos_per_file):
+                if self.current is part:
+                    self.current = None
+                self._close(part)
+
+    def _close(self, part):
+        self.close_part(part)
+        self.open_parts = [p for p in self.open_parts if p is not part]
+        for callback in part.callbacks:
+            callback()
+
+    def close(self):
+        with self.lock:
+            for part in list(self.open_parts):
+                self._close(part)
+            self.current = None
+
+class JsonLinesSink(Sink):
+    """ Comments as JSON lines, optionally gzip or zstd compressed
+
+    Partitioned files add a video_id field to every comment.
+
+    A compressed stream is only readable once closed, so compressed files
+    are written under a .tmp name, renamed when closed, and their flush
+    callbacks are held until then, as for Parquet. Appending to one starts a
+    new file instead of a new stream after one that may be cut short.
+    """
+
+    def __init__(self, directory='.', compression=None, batch_size=500, videos_per_file=0):
+        super(JsonLinesSink, self).__init__(directory, compression, batch_size, videos_per_file)
+        self.extension = '.json' + SUFFIXES[compression]
+
+    def open_part(self, path, append):
+        if self.compression is None:
+            return Part(path, open_output(path, None, append))
+        if append and os.path.exists(path):
+            path = path.replace(self.extension, '_%s%s' % (self.run_id, self.extension))
+
+        return Part(path, open_output(path + '.tmp', self.compression))
+
+    def write_rows(self, part, video_id, rows):
+        if self.videos_per_file:
+            rows = [dict(row, video_id=video_id) for row in rows]
+        data = ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf8')
+        with self.lock:
+            part.handle.write(data)
+
+    def flush_part(self, part, callback):
+        with self.lock:
+            part.handle.flush()
+            if self.compression is not None:
+                if callback is not None:
+                    part.callbacks.append(callback)
+                return
+        if callback is not None:
+            callback()
+
+    def close_part(self, part):
+        part.handle.close()
+        if self.compression is not None:
+            os.rename(part.path + '.tmp', part.path)
+
+class ParquetSink(Sink):
+    """ Comments as Parquet, written in row groups of `batch_size` comments
+
+    A Parquet file is only readable once closed, so it is written under a
+    .tmp name, renamed when closed, and flush callbacks are held until then.
+    """
+
+    extension = '.parquet'
+
+    def __init__(self, directory='.', compression='zstd', batch_size=50000, videos_per_file=100):
+        if pa is None:
+            raise ValueError('Parquet output needs the pyarrow package')
+        super(ParquetSink, self).__init__(directory, compression, batch_size, videos_per_file)
+        self.schema = pa.schema([(name, pa.string()) for name in COLUMNS])
+
+    def open_part(self, path, append):
+        if append and os.path.exists(path):
+            # Parquet files can't be appended to, continue in a new one
+            path = path.replace(self.extension, '_%s%s' % (self.run_id, self.extension))
+        return Part(path, None)
+
+    def write_rows(self, part, video_id, rows):
+        with self.lock:
+            part.rows.extend(dict(row, video_id=video_id) for row in rows)
+            if len(part.rows) >= self.batch_size:
+                self._write_group(part)
+
+    def _write_group(self, part):
+        if not part.rows:
+            return
+        if part.handle is None:
+            part.handle = pq.ParquetWriter(part.path + '.tmp', self.schema, compression=self.compression or 'none')
+        columns = dict((name, [None if row.get(name) is None else str(row.get(name)) for row in part.rows])
+                       for name in COLUMNS)
+        part.handle.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+        part.rows = []
+
+    def flush_part(self, part, callback):
+        if callback is not None:
+            with self.lock:
+                part.callbacks.append(callback)
+
+    def close_part(self, part):
+        self._write_group(part)
+        if part.handle is not None:
+            part.handle.close()
+            os.rename(part.path + '.tmp', part.path)
+
+def make_sink(fmt='jsonl', **kwargs):
+    """ Sink for an output format name """
+    if fmt == 'jsonl':
+        return JsonLinesSink(**kwargs)
+    if fmt == 'parquet':
+        return ParquetSink(**kwargs)
+
+    raise ValueError('Unknown output format: %s' % fmt)
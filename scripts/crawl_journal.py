@@ -0,0 +1,93 @@
+""" Persistent crawl state: progress of each video and the comments already stored """
+
+import json
+import time
+import sqlite3
+import threading
+
+class CrawlJournal(object):
+    """ SQLite journal of finished videos and per-video checkpoints
+
+    A video is either 'done' or sitting at a checkpoint: the stage it is in
+    ('comments' or 'replies'), the next page_token to request and the reply
+    cids that still have to be fetched.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS videos ('
+                        'video_id TEXT PRIMARY KEY, '
+                        'status TEXT NOT NULL, '
+                        'stage TEXT, '
+                        'page_token TEXT, '
+                        'reply_cids TEXT, '
+                        'updated REAL)')
+        self.db.commit()
+
+    def finished(self):
+        """ Set of video ids that were fully downloaded """
+        with self.lock:
+            rows = self.db.execute("SELECT video_id FROM videos WHERE status = 'done'").fetchall()
+        return set(row[0] for row in rows)
+
+    def state(self, video_id):
+        """ Last checkpoint of a partially downloaded video, or None """
+        with self.lock:
+            row = self.db.execute("SELECT stage, page_token, reply_cids FROM videos "
+                                  "WHERE video_id = ? AND status = 'partial'", (video_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {'stage': row[0], 'page_token': row[1], 'reply_cids': json.loads(row[2] or '[]')}
+
+    def checkpoint(self, video_id, stage, page_token, reply_cids):
+        """ Record that everything before page_token / reply_cids is saved """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)',
+                            (video_id, 'partial', stage, page_token, json.dumps(reply_cids), time.time()))
+            self.db.commit()
+
+    def finish(self, video_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO videos VALUES (?, 'done', NULL, NULL, NULL, ?)",
+                            (video_id, time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class SeenIndex(object):
+    """ On-disk set of comment ids already stored for each video, shared across runs """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen ('
+                        'video_id TEXT NOT NULL, '
+                        'cid TEXT NOT NULL, '
+                        'PRIMARY KEY (video_id, cid)) WITHOUT ROWID')
+        self.db.commit()
+
+    def load(self, video_id):
+        """ Set of cids stored for a video """
+        with self.lock:
+            rows = self.db.execute('SELECT cid FROM seen WHERE video_id = ?', (video_id,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def add(self, video_id, cids):
+        if not cids:
+            return
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                                ((video_id, cid) for cid in cids))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -4,102 +4,208 @@
 from __future__ import print_function
 
 import os
-import sys
 import time
 import json
+import threading
 import requests
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-import numpy as np
 import bs4
 import pytz
 import lxml.html
-from lxml.cssselect import CSSSelector
+from io import BytesIO
+from lxml import etree
+from crawl_journal import CrawlJournal, SeenIndex
+from comment_sinks import make_sink, Progress
+from retry_policy import RetryPolicy, CircuitBreaker
+import instrument
 
-YOUTUBE_COMMENTS_URL = 'https://www.youtube.com/all_comments?v={youtube_id}'
-YOUTUBE_COMMENTS_AJAX_URL = 'https://www.youtube.com/comment_ajax'
+YOUTUBE_BASE_URL = 'https://www.youtube.com'
+YOUTUBE_COMMENTS_URL = '{base_url}/all_comments?v={youtube_id}'
+YOUTUBE_COMMENTS_AJAX_URL = '{base_url}/comment_ajax'
 
 USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/48.0.2564.116 Safari/537.36'
 
+class RateLimiter(object):
+    """ Token bucket shared by all download workers """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request may be sent """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            instrument.add_time('rate_limit_wait', wait)
+            time.sleep(wait)
+
+def make_adapter(pool_size=10):
+    """ Connection pool that can be mounted on several sessions """
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+def make_session(adapter=None):
+    """ New session (own cookies / XSRF token) on a shared connection pool """
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    if adapter is not None:
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    return session
+
 def find_value(html, key, num_chars=2):
     pos_begin = html.find(key) + len(key) + num_chars
     pos_end = html.find('"', pos_begin)
 
     return html[pos_begin: pos_end]
 
-def extract_comments(html):
-    tree = lxml.html.fromstring(html)
-    item_sel = CSSSelector('.comment-item')
-    text_sel = CSSSelector('.comment-text-content')
-    time_sel = CSSSelector('.time')
-    author_sel = CSSSelector('.user-name')
-    lvote_sel = CSSSelector('.like-count')
-    dvote_sel = CSSSelector('.dislike-count')
-
-    for item in item_sel(tree):
-        if (len(dvote_sel(item)) > 0) and (len(lvote_sel(item)) > 0):
-            yield {'cid': item.get('data-cid'),
-                   'text': text_sel(item)[0].text_content(),
-                   'time': time_sel(item)[0].text_content().strip(),
-                   'author': author_sel(item)[0].text_content(),
-                   'clikes': lvote_sel(item)[0].text_content(),
-                   'cdislikes': dvote_sel(item)[0].text_content()}
-        elif (len(dvote_sel(item)) == 0) and (len(lvote_sel(item)) == 0):
-            yield {'cid': item.get('data-cid'),
-                   'text': text_sel(item)[0].text_content(),
-                   'time': time_sel(item)[0].text_content().strip(),
-                   'author': author_sel(item)[0].text_content(),
-                   'clikes': 0,
-                   'cdislikes': 0}
-        elif (len(lvote_sel(item)) == 0):
-            yield {'cid': item.get('data-cid'),
-                   'text': text_sel(item)[0].text_content(),
-                   'time': time_sel(item)[0].text_content().strip(),
-                   'author': author_sel(item)[0].text_content(),
-                   'clikes': 0,
-                   'cdislikes': dvote_sel(item)[0].text_content()}
+def _has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+# Compiled once, evaluated for every page
+ITEM_XPATH = etree.XPath('//*[%s]' % _has_class('comment-item'))
+REPLY_CID_XPATH = etree.XPath('//*[%s]/*[%s]/@data-cid' % (_has_class('comment-replies-header'),
+                                                            _has_class('load-comments')),
+                              smart_strings=False)
+TEXT_XPATH = etree.XPath('string((.//*[%s])[1])' % _has_class('comment-text-content'), smart_strings=False)
+TIME_XPATH = etree.XPath('string((.//*[%s])[1])' % _has_class('time'), smart_strings=False)
+AUTHOR_XPATH = etree.XPath('string((.//*[%s])[1])' % _has_class('user-name'), smart_strings=False)
+LVOTE_XPATH = etree.XPath('(.//*[%s])[1]' % _has_class('like-count'))
+DVOTE_XPATH = etree.XPath('(.//*[%s])[1]' % _has_class('dislike-count'))
+
+def parse_comment(item):
+    """ Comment dict from a .comment-item element """
+    lvote = LVOTE_XPATH(item)
+    dvote = DVOTE_XPATH(item)
+
+    return {'cid': item.get('data-cid'),
+            'text': TEXT_XPATH(item),
+            'time': TIME_XPATH(item).strip(),
+            'author': AUTHOR_XPATH(item),
+            'clikes': ''.join(lvote[0].itertext()) if lvote else 0,
+            'cdislikes': ''.join(dvote[0].itertext()) if dvote else 0}
+
+def _classes(elem):
+    """ An element's class attribute padded with spaces, whitespace normalized as by _has_class """
+    return ' %s ' % ' '.join((elem.get('class') or '').split())
+
+def iterparse_page(html):
+    """ Like extract_page, but frees each comment's elements as soon as it is read """
+    comments = []
+    reply_cids = []
+    source = BytesIO(html.encode('utf8'))
+    for _, elem in etree.iterparse(source, events=('end',), html=True, encoding='utf8'):
+        classes = _classes(elem)
+        if ' load-comments ' in classes:
+            parent = elem.getparent()
+            if parent is not None and ' comment-replies-header ' in _classes(parent):
+                reply_cids.append(elem.get('data-cid'))
+        elif ' comment-item ' in classes:
+            comments.append(parse_comment(elem))
+            elem.clear()
+            # drop earlier items, they have been read already
+            prev = elem.getprevious()
+            while prev is not None and ' comment-item ' in _classes(prev):
+                elem.getparent().remove(prev)
+                prev = elem.getprevious()
+
+    return comments, reply_cids
+
+def extract_page(html, stream=False):
+    """ Parse a page once, return its comments and the cids of comments with replies """
+    with instrument.timer('parse'):
+        if stream:
+            comments, reply_cids = iterparse_page(html)
         else:
-            yield {'cid': item.get('data-cid'),
-                   'text': text_sel(item)[0].text_content(),
-                   'time': time_sel(item)[0].text_content().strip(),
-                   'author': author_sel(item)[0].text_content(),
-                   'clikes': lvote_sel(item)[0].text_content(),
-                   'cdislikes': 0}
+            tree = lxml.html.fromstring(html)
+            comments, reply_cids = [parse_comment(item) for item in ITEM_XPATH(tree)], REPLY_CID_XPATH(tree)
+    instrument.count('comments_parsed', len(comments))
+
+    return comments, reply_cids
+
+def extract_comments(html):
+    for comment in extract_page(html)[0]:
+        yield comment
 
 def extract_reply_cids(html):
-    tree = lxml.html.fromstring(html)
-    sel = CSSSelector('.comment-replies-header > .load-comments')
-    return [i.get('data-cid') for i in sel(tree)]
+    return extract_page(html)[1]
 
 
-def ajax_request(session, url, params, data, retries=10, sleep_min=60, sleep_max=400):
-    for _ in range(retries):
-        response = session.post(url, params=params, data=data)
-        if response.status_code == 200:
-            response_dict = json.loads(response.text)
-            return response_dict.get('page_token', None), response_dict['html_content']
-        else:
-            print('Sleeping...')
-            time.sleep(np.random.sample() * np.random.randint(sleep_min, high=sleep_max))
+def ajax_request(session, url, params, data, policy=None, limiter=None):
+    """ POST to the comment ajax endpoint, raises RetryError if it keeps failing """
+    policy = policy or RetryPolicy()
+    response = policy.request(lambda timeout: session.post(url, params=params, data=data, timeout=timeout),
+                              url, limiter)
+    instrument.count('pages_fetched')
+    response_dict = json.loads(response.text)
 
-def download_comments(youtube_id, sleep=1):
-    session = requests.Session()
-    session.headers['User-Agent'] = USER_AGENT
+    return response_dict.get('page_token', None), response_dict['html_content']
+
+def download_comments(youtube_id, sleep=1, session=None, limiter=None, base_url=YOUTUBE_BASE_URL,
+                      state=None, checkpoint=None, seen=None, incremental=False, stream=False,
+                      policy=None):
+    """ Yield the comments of a video
+
+    state is a checkpoint from an earlier run ({'stage', 'page_token', 'reply_cids'}),
+    comments before it are not yielded again. checkpoint(stage, page_token, reply_cids)
+    is called each time a page has been fully consumed.
+
+    seen holds cids stored by earlier runs, which are never yielded. With incremental,
+    paging stops at the first page (newest first) that reaches one of them.
+    stream parses pages incrementally, for very large pages.
+
+    Raises RetryError when a page cannot be fetched, rather than ending early.
+    """
+    if session is None:
+        session = make_session()
+    policy = policy or RetryPolicy()
+    ajax_url = YOUTUBE_COMMENTS_AJAX_URL.format(base_url=base_url)
 
     # Get Youtube page with initial comments
-    response = session.get(YOUTUBE_COMMENTS_URL.format(youtube_id=youtube_id))
+    url = YOUTUBE_COMMENTS_URL.format(base_url=base_url, youtube_id=youtube_id)
+    response = policy.request(lambda timeout: session.get(url, timeout=timeout), url, limiter)
+    instrument.count('pages_fetched')
     html = response.text
-    reply_cids = extract_reply_cids(html)
+    comments, page_reply_cids = extract_page(html, stream)
 
-    ret_cids = []
-    for comment in extract_comments(html):
-        ret_cids.append(comment['cid'])
-        yield comment
+    seen = seen or set()
+    ret_cids = set(seen)
+    if state is None:
+        reply_cids = page_reply_cids
+        for comment in comments:
+            if comment['cid'] not in ret_cids:
+                ret_cids.add(comment['cid'])
+                yield comment
 
-    page_token = find_value(html, 'data-token')
-    session_token = find_value(html, 'XSRF_TOKEN', 4)
+        page_token = find_value(html, 'data-token')
+        first_iteration = True
+        if checkpoint is not None:
+            checkpoint('comments', None, reply_cids)
+    else:
+        # Already saved, but keep them from being yielded twice by the first ajax page
+        ret_cids.update(comment['cid'] for comment in comments)
+        reply_cids = list(state['reply_cids'])
+        if state['stage'] == 'comments':
+            page_token = state['page_token'] or find_value(html, 'data-token')
+            first_iteration = state['page_token'] is None
+        else:
+            page_token = None
 
-    first_iteration = True
+    session_token = find_value(html, 'XSRF_TOKEN', 4)
+    queued = set(reply_cids)
 
     # Get remaining comments (the same as pressing the 'Show more' button)
     while page_token:
@@ -115,23 +221,32 @@ def download_comments(youtube_id, sleep=1):
         else:
             data['page_token'] = page_token
 
-        response = ajax_request(session, YOUTUBE_COMMENTS_AJAX_URL, params, data)
-        if not response:
-            break
-
-        page_token, html = response
-
-        reply_cids += extract_reply_cids(html)
-        for comment in extract_comments(html):
-            if comment['cid'] not in ret_cids:
-                ret_cids.append(comment['cid'])
+        page_token, html = ajax_request(session, ajax_url, params, data, policy, limiter)
+        comments, page_reply_cids = extract_page(html, stream)
+
+        # the first ajax page repeats the initial one, don't queue its replies twice
+        reply_cids += [cid for cid in page_reply_cids if cid not in queued]
+        queued.update(reply_cids)
+        reached_seen = False
+        for comment in comments:
+            if comment['cid'] in seen:
+                reached_seen = True
+            elif comment['cid'] not in ret_cids:
+                ret_cids.add(comment['cid'])
                 yield comment
 
+        if incremental and reached_seen:
+            # everything after this page was stored by an earlier crawl
+            page_token = None
+
+        if checkpoint is not None:
+            checkpoint('comments' if page_token else 'replies', page_token, reply_cids)
         first_iteration = False
+        instrument.add_time('page_sleep', sleep)
         time.sleep(sleep)
 
     # Get replies (the same as pressing the 'View all X replies' link)
-    for cid in reply_cids:
+    for i, cid in enumerate(reply_cids):
         data = {'comment_id': cid,
                 'video_id': youtube_id,
                 'can_reply': 1,
@@ -142,41 +257,167 @@ def download_comments(youtube_id, sleep=1):
                   'filter': youtube_id,
                   'tab': 'inbox'}
 
-        response = ajax_request(session, YOUTUBE_COMMENTS_AJAX_URL, params, data)
-        if not response:
-            break
-
-        _, html = response
+        _, html = ajax_request(session, ajax_url, params, data, policy, limiter)
 
-        for comment in extract_comments(html):
+        for comment in extract_page(html, stream)[0]:
             if comment['cid'] not in ret_cids:
-                ret_cids.append(comment['cid'])
+                ret_cids.add(comment['cid'])
                 yield comment
+
+        if checkpoint is not None:
+            checkpoint('replies', None, reply_cids[i + 1:])
+        instrument.add_time('page_sleep', sleep)
         time.sleep(sleep)
 
 def get_args():
     parser = argparse.ArgumentParser(add_help=False, description=('Download Youtube comments without using the Youtube API'))
     parser.add_argument('--youtubeids', '-y', help='File containing IDs of Youtube videos for scraping, separated by line', required=True)
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Number of videos to download concurrently')
+    parser.add_argument('--rate', '-r', type=float, default=2.0, help='Max requests per second across all workers (with --workers, must be above 0)')
+    parser.add_argument('--burst', type=int, help='Token bucket size for --rate (defaults to --rate)')
+    parser.add_argument('--base-url', default=YOUTUBE_BASE_URL, help='Base URL to crawl, e.g. a local stub server')
+    parser.add_argument('--retries', type=int, default=8, help='Retries per request before a video is given up')
+    parser.add_argument('--max-backoff', type=float, default=300.0, help='Longest sleep between retries, in seconds')
+    parser.add_argument('--breaker-threshold', type=int, default=5, help='Failures in a row before requests to a host are held')
+    parser.add_argument('--breaker-cooldown', type=float, default=30.0, help='Seconds requests are held once the breaker opens')
+    parser.add_argument('--connect-timeout', type=float, default=10.0, help='Seconds to wait for a connection before retrying')
+    parser.add_argument('--read-timeout', type=float, default=60.0, help='Seconds to wait for data on a connection before retrying')
+    parser.add_argument('--output-dir', '-o', default='.', help='Directory to write comments to')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', help='Output file format')
+    parser.add_argument('--compression', choices=['none', 'gzip', 'zstd'],
+                        help='Compression of output files (default: none for jsonl, zstd for parquet)')
+    parser.add_argument('--videos-per-file', type=int,
+                        help='Videos per output file, 0 for one file per video (default: 0 for jsonl, 100 for parquet)')
+    parser.add_argument('--batch-size', type=int,
+                        help='Comments buffered before each write (default: 500 for jsonl, 50000 for parquet)')
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Seconds between progress updates')
+    parser.add_argument('--journal', '-j', default='crawl_journal.db', help='SQLite file recording crawl progress')
+    parser.add_argument('--resume', action='store_true', help='Skip finished videos and continue partial ones from the journal')
+    parser.add_argument('--seen-index', help='SQLite file of comment ids stored by earlier crawls, which are not saved again')
+    parser.add_argument('--stream-parse', action='store_true', help='Parse pages incrementally to keep memory low on very large pages')
+    parser.add_argument('--incremental', action='store_true', help='Stop paging a video once already stored comments are reached (needs --seen-index)')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
+    if args.workers > 1 and args.rate <= 0:
+        # concurrent downloads don't sleep between pages, the rate limiter is all that throttles them
+        parser.error('--rate must be above 0 with --workers')
 
     return args
 
+def save_comments(youtube_id, sink, session=None, limiter=None, base_url=YOUTUBE_BASE_URL, sleep=1,
+                  journal=None, resume=False, seen_index=None, incremental=False, stream=False,
+                  policy=None, progress=None):
+    """ Download one video's comments into sink, return the count """
+    video_id = youtube_id.strip()
+    state = journal.state(video_id) if (journal is not None and resume) else None
+    seen = seen_index.load(video_id) if seen_index is not None else None
+    new_cids = []
+    count = 0
+
+    def saved(cids, *journal_args):
+        # returns what to record once the comments are safely on disk
+        def record():
+            if seen_index is not None:
+                seen_index.add(video_id, cids)
+            if journal is not None:
+                if journal_args:
+                    journal.checkpoint(video_id, *journal_args)
+                else:
+                    journal.finish(video_id)
+        return record
+
+    writer = sink.writer(video_id, append=bool(state or seen))
+
+    def checkpoint(stage, page_token, reply_cids):
+        writer.flush(saved(list(new_cids), stage, page_token, list(reply_cids)))
+        del new_cids[:]
+
+    try:
+        for comment in download_comments(video_id, sleep=sleep, session=session, limiter=limiter,
+                                         base_url=base_url, state=state, checkpoint=checkpoint,
+                                         seen=seen, incremental=incremental, stream=stream,
+                                         policy=policy):
+            writer.write(comment)
+            new_cids.append(comment['cid'])
+            count += 1
+            if progress is not None:
+                progress.add()
+    except Exception:
+        writer.close()
+        raise
+
+    writer.close(saved(new_cids))
+    if progress is not None:
+        progress.add(0, 1)
+
+    return count
+
+def download_concurrent(youtube_ids, workers, limiter, **kwargs):
+    """ Download many videos at once on a bounded thread pool """
+    adapter = make_adapter(workers)
+    local = threading.local()
+
+    def worker(youtube_id):
+        # one session per thread so cookies stay consistent, all sharing the pool
+        if not hasattr(local, 'session'):
+            local.session = make_session(adapter)
+        return save_comments(youtube_id, session=local.session, limiter=limiter, sleep=0, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(worker, vid), vid) for vid in youtube_ids)
+        for future in as_completed(futures):
+            youtube_id = futures[future].strip()
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to download video %s: %s' % (youtube_id, e))
+
 def main():
     args = get_args()
+    instrument.start(args)
+    journal = CrawlJournal(args.journal)
+    seen_index = SeenIndex(args.seen_index) if args.seen_index else None
 
     with open(args.youtubeids) as ytf:
-        for youtube_id in ytf:
-            print('Downloading data for video:', youtube_id.strip())
-            count = 0
-            
-            with open(youtube_id + '_comments.json', 'w', encoding='utf8') as fp:
-                for comment in download_comments(youtube_id.strip()):
-                    print(json.dumps(comment, ensure_ascii=False), file=fp)
-                    count += 1
-                    sys.stdout.write('Downloaded %d comment(s)\r' % count)
-                    sys.stdout.flush()
-
+        youtube_ids = [line for line in ytf if line.strip()]
+
+    if args.resume:
+        finished = journal.finished()
+        youtube_ids = [vid for vid in youtube_ids if vid.strip() not in finished]
+        print('Resuming, %d video(s) left to download' % len(youtube_ids))
+
+    policy = RetryPolicy(max_retries=args.retries, cap=args.max_backoff,
+                         breaker=CircuitBreaker(args.breaker_threshold, args.breaker_cooldown),
+                         timeout=(args.connect_timeout, args.read_timeout))
+    # options left out keep the format's own defaults
+    sink_options = dict((name, value) for name, value in [('batch_size', args.batch_size),
+                                                           ('videos_per_file', args.videos_per_file)]
+                        if value is not None)
+    if args.compression is not None:
+        sink_options['compression'] = None if args.compression == 'none' else args.compression
+    sink = make_sink(args.format, directory=args.output_dir, **sink_options)
+    progress = Progress(args.progress_interval)
+    options = dict(sink=sink, base_url=args.base_url, journal=journal, resume=args.resume, policy=policy,
+                   seen_index=seen_index, incremental=args.incremental, stream=args.stream_parse,
+                   progress=progress)
+    if args.workers > 1:
+        limiter = RateLimiter(args.rate, args.burst)
+        download_concurrent(youtube_ids, args.workers, limiter, **options)
+    else:
+        for youtube_id in youtube_ids:
+            try:
+                save_comments(youtube_id, **options)
+            except Exception as e:
+                # skip the video, as download_concurrent does
+                print('\nFailed to download video %s: %s' % (youtube_id.strip(), e))
+
+    sink.close()
+    print('\nDownloaded %d comment(s) from %d video(s)' % (progress.comments, progress.videos))
+    print('Retries: %s' % json.dumps(policy.stats.snapshot()))
+    journal.close()
+    if seen_index is not None:
+        seen_index.close()
     print('\nDone!')
 
 if __name__ == "__main__":
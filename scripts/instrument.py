@@ -0,0 +1,205 @@
+""" Stage timers and counters shared by the pipeline scripts, and their --metrics / --profile options
+
+Code anywhere in a script counts events and times stages on the shared
+`metrics`:
+
+    with instrument.timer('predict'):
+        prob = model.predict(batch)
+    instrument.count('predictions', len(batch))
+
+A script adds the options with add_arguments(parser) and calls start(args)
+first thing in main(). At exit, --metrics writes the totals as JSON or
+Prometheus text, and --profile writes a cProfile or sampling profile of the
+run. Worker processes keep their own metrics: a worker sends what take()
+returns to the parent, which adds it to its own with merge().
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+class Metrics(object):
+    """ Thread-safe counters, and timers that keep a count, total and max of seconds """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            calls, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def take(self):
+        """ Counters and timers recorded since the last take, for merge() in another process """
+        with self.lock:
+            taken = {'counters': self.counters, 'timers': self.timers}
+            self.counters = {}
+            self.timers = {}
+
+        return taken
+
+    def merge(self, taken):
+        """ Add counters and timers from take() in a worker process """
+        with self.lock:
+            for name, n in taken['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, (calls, total, longest) in taken['timers'].items():
+                own_calls, own_total, own_longest = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (own_calls + calls, own_total + total, max(own_longest, longest))
+
+    def snapshot(self):
+        with self.lock:
+            return {'script': script_name(),
+                    'wall_seconds': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'timers': dict((name, {'calls': calls, 'seconds': total, 'max_seconds': longest})
+                                   for name, (calls, total, longest) in self.timers.items())}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='pipeline'):
+        """ Prometheus text format, labelled with the script name """
+        snapshot = self.snapshot()
+        label = '{script="%s"}' % snapshot['script']
+        lines = ['# TYPE %s_wall_seconds gauge' % prefix,
+                 '%s_wall_seconds%s %f' % (prefix, label, snapshot['wall_seconds'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total%s %s' % (prefix, name, label, value))
+        for name, timer in sorted(snapshot['timers'].items()):
+            lines.append('# TYPE %s_%s_seconds summary' % (prefix, name))
+            lines.append('%s_%s_seconds_count%s %d' % (prefix, name, label, timer['calls']))
+            lines.append('%s_%s_seconds_sum%s %f' % (prefix, name, label, timer['seconds']))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, fmt=None):
+        """ Write the metrics to path ('-' for stderr), as Prometheus text for .prom files or fmt='prometheus' """
+        if fmt is None:
+            fmt = 'prometheus' if path.endswith('.prom') else 'json'
+        text = self.to_prometheus() if fmt == 'prometheus' else self.to_json() + '\n'
+        if path == '-':
+            sys.stderr.write(text)
+            return
+        with open(path, 'w') as f:
+            f.write(text)
+
+metrics = Metrics()
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+def add_time(name, seconds):
+    metrics.add_time(name, seconds)
+
+def timer(name):
+    return metrics.timer(name)
+
+def take():
+    return metrics.take()
+
+def merge(taken):
+    metrics.merge(taken)
+
+def script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+
+class Sampler(object):
+    """ Sampling profiler: records every thread's stack each interval seconds
+
+    Unlike cProfile it sees all threads (download workers, the tokenizer
+    thread) and costs little. Stacks are written in the collapsed format that
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self, path):
+        self.stopped.set()
+        self.thread.join()
+        with open(path, 'w') as f:
+            for stack, samples in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, samples))
+
+def add_arguments(parser):
+    """ Add --metrics, --metrics-format, --profile and --profile-output to a script's parser """
+    parser.add_argument('--metrics', help='Write stage timers and counters here at exit (- for stderr)')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                        help='Format of --metrics (default: prometheus for .prom files, json otherwise)')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='Profile the run with cProfile (main thread only) or by sampling all threads')
+    parser.add_argument('--profile-output', help='File for the profile (default: <script>.prof or <script>.stacks)')
+
+def start(args):
+    """ Start profiling if asked, and write the profile and metrics when the script exits """
+    profile = getattr(args, 'profile', None)
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        path = args.profile_output or script_name() + '.prof'
+        profiler.enable()
+
+        def finish_profile():
+            profiler.disable()
+            profiler.dump_stats(path)
+            print('cProfile stats written to %s (python -m pstats %s)' % (path, path), file=sys.stderr)
+        atexit.register(finish_profile)
+    elif profile == 'sample':
+        sampler = Sampler()
+        path = args.profile_output or script_name() + '.stacks'
+        sampler.start()
+
+        def finish_profile():
+            sampler.stop(path)
+            print('Sampled stacks written to %s' % path, file=sys.stderr)
+        atexit.register(finish_profile)
+
+    if getattr(args, 'metrics', None):
+        # registered last so it runs first, before the profile is written
+        atexit.register(metrics.dump, args.metrics, args.metrics_format)
@@ -2,82 +2,418 @@
 """ Script to process YouTube data """
 
 import os
-import time
 import sys
+import glob
+import io
 import json
+import hashlib
+import argparse
+import multiprocessing
 import pandas as pd
 import numpy as np
 import fastText
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+import instrument
 
-def get_comments(infile):
-    """Returns a table of comment info"""
+def comment_file(directory, vid):
+    """ Path of the downloaded comments for a video, compressed or not """
+    for suffix in ['.json', '.json.gz', '.json.zst', '.parquet']:
+        path = os.path.join(directory, vid + '_comments' + suffix)
+        if os.path.exists(path):
+            return path
+    # files from before the video id was stripped
+    return os.path.join(directory, vid + '\n_comments.json')
 
-    count = 0
-    lines = 0
+def comment_files(directory, vid):
+    """ Paths of all the downloaded comments for a video
+
+    A resumed compressed or Parquet crawl continues in
+    <vid>_comments_<run>.json.gz (or .zst, or .parquet) next to the first file.
+    """
+    parts = [path for suffix in ['.json.gz', '.json.zst', '.parquet']
+             for path in glob.glob(os.path.join(directory, vid + '_comments_*' + suffix))]
+
+    return [comment_file(directory, vid)] + sorted(parts)
+
+def partition_files(directory):
+    """ Paths of the comment files shared by several videos, comments_<run>_<n>.*
+
+    download_comments writes these with --videos-per-file, and by default
+    for Parquet. Each comment in them has a video_id field.
+    """
+    return sorted(path for suffix in ['.json', '.json.gz', '.json.zst', '.parquet']
+                  for path in glob.glob(os.path.join(directory, 'comments_*_*' + suffix)))
+
+def comment_sources(directory, vids):
+    """ (video id, path) of the comment files for the videos, with None for partition files """
+    sources = [(vid, path) for vid in vids for path in comment_files(directory, vid)]
+
+    return [source for source in sources + [(None, path) for path in partition_files(directory)]
+            if os.path.exists(source[1])]
+
+def write_sets(comments, count, set_size, outdir):
+    """ Shuffle and write full sets of set_size comments, returns leftovers and the next set number """
+    n_sets = len(comments) // set_size
+    for i in range(n_sets):
+        comment_set = comments[i * set_size:(i + 1) * set_size]
+        write_set(comment_set, count, outdir)
+        count += 1
+
+    return comments[n_sets * set_size:], count
+
+def write_set(comments, count, outdir):
+    """ Write set number count, shuffled the same way every time it is written """
+    comments = comments.sample(frac=1, random_state=count).reset_index(drop=True)
+    with instrument.timer('write_sets'):
+        comments.to_csv(os.path.join(outdir, 'comments_set_' + str(count) + '.csv'))
+    instrument.count('sets_written')
+
+def read_comments(path, start=0, end=None, chunksize=10000):
+    """ Chunks of a comment file's comments, of a plain file only those from byte start up to end """
+    if path.endswith('.parquet'):
+        if pq is None:
+            raise ValueError('Reading %s needs the pyarrow package' % path)
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    if path.endswith(('.gz', '.zst')):
+        for chunk in pd.read_json(path, lines=True, chunksize=chunksize, dtype=False, convert_dates=False):
+            yield chunk
+        return
+
+    if end is None:
+        end = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        while fp.tell() < end:
+            lines = []
+            while len(lines) < chunksize and fp.tell() < end:
+                lines.append(fp.readline())
+            yield pd.read_json(io.StringIO(b''.join(lines).decode('utf8')), lines=True,
+                               dtype=False, convert_dates=False)
+
+def split_comments(sources, outdir='./', set_size=500, count=0, chunksize=10000, vids=None):
+    """ Splits comments into shuffled tables of set_size comments, numbered from count
+
+    sources are (video id, comment file, start, end) with the byte range of
+    a plain file to read. A video id of None is a partition file, whose
+    comments name their video; only those of videos in vids are kept.
+    Returns the next set number.
+    """
     com_total = 0
+    pending = []
+    pending_rows = 0
+    last_source = None
+    vids = None if vids is None else set(vids)
+    for vid, path, start, end in sources:
+        source = vid if vid is not None else path
+        if source != last_source:
+            print(source)
+            last_source = source
+        for chunk in read_comments(path, start, end, chunksize):
+            if vid is None and vids is not None:
+                chunk = chunk[chunk['video_id'].isin(vids)]
+            # Parquet comments have a video_id too, kept after the comment's own fields
+            video_id = chunk['video_id'] if vid is None else vid
+            chunk = chunk.drop(columns='video_id', errors='ignore').assign(video_id=video_id)
+            chunk['desc'] = '-'
+            chunk['category'] = '-'
+            pending.append(chunk)
+            pending_rows += len(chunk)
+            com_total += len(chunk)
+            instrument.count('comments_read', len(chunk))
+
+            if pending_rows >= set_size:
+                comments, count = write_sets(pd.concat(pending, ignore_index=True),
+                                             count, set_size, outdir)
+                pending = [comments]
+                pending_rows = len(comments)
+
+            sys.stdout.write('Processed %d comments\r' % com_total)
+            sys.stdout.flush()
+
+    # Write whatever is left to a file
+    if pending_rows:
+        write_set(pd.concat(pending, ignore_index=True), count, outdir)
+        count += 1
+
+    return count
+
+def video_ids(infile):
     with open(infile) as ytdl:
-        for vid in ytdl:
-            print(vid)
-            vid = vid.strip()
-            with open('comments/'+vid+'\n_comments.json') as cm:
-                for com in cm:
-                    singlecom = pd.DataFrame.from_dict(json.loads(com), orient='index').transpose()
-                    singlecom['video_id'] = vid
-                    singlecom['desc'] = '-'
-                    singlecom['category'] = '-'
-                    if lines == 0:
-                        comments = singlecom
-                        lines +=1
-                    elif lines % 500 == 0:
-                        # Shuffle comments randomly before writing
-                        comments = comments.sample(frac=1).reset_index(drop=True)
-                        comments.to_csv('comments_set_' + str(count) + '.csv')
-                        count += 1
-                        lines = 0
-                    else:
-                        comments = comments.append(singlecom)
-                        lines += 1
-                    
-                    com_total += 1
-                    sys.stdout.write('Processed %d comments\r' % com_total)
-                    time.sleep(0.1)
-                    sys.stdout.flush()
-        else:
-            # Write whatever is left to a file
-            comments.to_csv('comments_set_' + count + '.csv')
+        return [vid.strip() for vid in ytdl if vid.strip()]
+
+def get_comments(infile, directory='comments/', outdir='./', set_size=500, chunksize=10000):
+    """ Splits the comments of the videos in infile into shuffled tables of set_size comments """
+    vids = video_ids(infile)
+    sources = [(vid, path, 0, None) for vid, path in comment_sources(directory, vids)]
+
+    return split_comments(sources, outdir, set_size, chunksize=chunksize, vids=vids)
 
 def pred_lang(text, model):
     """ Predict most likely language used"""
     
     return model.predict(text)[0][0].replace('__label__', '')
 
-def filter_lang(files, lang, model, directory):
+def pred_langs(texts, model, batch_size=10000):
+    """ Predict the most likely language and its probability for many texts at once """
+    langs = []
+    probs = []
+    for start in range(0, len(texts), batch_size):
+        with instrument.timer('fasttext'):
+            labels, prob = model.predict(texts[start:start + batch_size])
+        instrument.count('language_predictions', len(labels))
+        langs.extend(label[0].replace('__label__', '') for label in labels)
+        probs.extend(p[0] for p in prob)
+
+    return np.array(langs), np.array(probs)
+
+def filter_file(f, lang, model, directory, threshold=0.0, batch_size=10000, outdir=None):
+    """ Keep the comments of one file predicted as lang with at least threshold probability """
+    try:
+        comments = pd.read_csv(directory+f, index_col=0)
+    except pd.errors.ParserError:
+        comments = pd.read_csv(directory+f, index_col=0, lineterminator='\n')
+    comments['text'] = comments['text'].astype(str).str.replace('\n', ' ', regex=False)
+    langs, probs = pred_langs(comments['text'].tolist(), model, batch_size)
+    comments['lang'] = langs
+    comments = comments[(langs == lang) & (probs >= threshold)]
+    instrument.count('comments_kept', len(comments))
+    if outdir is None:
+        outdir = directory+'filtered/'
+    comments.to_csv(os.path.join(outdir, 'filtered_'+f))
+
+    return len(comments)
+
+def filter_lang(files, lang, model, directory, threshold=0.0, batch_size=10000, outdir=None):
     """ Filter by predicted language """
     
     for f in files:
         print(f)
-        try:
-            comments = pd.read_csv(directory+f, index_col=0)
-        except pd.errors.ParserError:
-            comments = pd.read_csv(directory+f, index_col=0, lineterminator='\n')
-        comments['text'] = comments['text'].apply(lambda x: str(x).replace('\n',' '))
-        comments['lang'] = comments['text'].apply(lambda x: pred_lang(x, model))
-        comments = comments[comments['lang'] == lang]
-        comments.to_csv(directory+'filtered/filtered_'+f)
+        filter_file(f, lang, model, directory, threshold, batch_size, outdir)
+
+# Model loaded once in each worker process
+_worker_model = None
+
+def _init_worker(model_path):
+    global _worker_model
+    _worker_model = fastText.load_model(model_path)
+
+def _filter_worker(job):
+    f, lang, directory, threshold, batch_size, outdir = job
+    kept = filter_file(f, lang, _worker_model, directory, threshold, batch_size, outdir)
+
+    # the file's metrics go back with it, to be merged into the parent's
+    return f, kept, instrument.take()
+
+def filter_lang_parallel(files, lang, model_path, directory, workers=None, threshold=0.0, batch_size=10000,
+                         outdir=None, done=None):
+    """ Filter by predicted language, files spread over a pool of worker processes
+
+    done(f) is called in this process as each file finishes.
+    """
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model_path,))
+    try:
+        jobs = [(f, lang, directory, threshold, batch_size, outdir) for f in files]
+        for f, kept, taken in pool.imap_unordered(_filter_worker, jobs):
+            instrument.merge(taken)
+            print('%s: kept %d comments' % (f, kept))
+            if done is not None:
+                done(f)
+    finally:
+        pool.close()
+        pool.join()
+
+def file_hash(path, params=''):
+    """ Hash of a file's content and the settings it is processed with """
+    digest = hashlib.sha1(params.encode('utf8'))
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+class Manifest(object):
+    """ Hashes of the inputs each stage processed last time, to skip unchanged ones """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.entries = json.load(fp)
+
+    def get(self, stage, key):
+        return self.entries.get(stage, {}).get(key)
+
+    def unchanged(self, stage, key, digest):
+        return self.get(stage, key) == digest
+
+    def record(self, stage, key, digest):
+        self.entries.setdefault(stage, {})[key] = digest
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.entries, fp, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def whole_lines(path):
+    """ Size of a plain file up to its last complete line, as one still being appended to """
+    end = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        while end > 0:
+            start = max(0, end - (1 << 16))
+            fp.seek(start)
+            newline = fp.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+
+    return 0
+
+def scan_comments(path, split_before=None):
+    """ Size and hash of a comment file, and where the comments not split before start
+
+    split_before is the (size, hash) recorded when the file was last split.
+    The start is 0 for a new file, the old size for a plain file that only
+    had comments appended, and None for a file that was rewritten.
+    """
+    compressed = path.endswith(('.gz', '.zst', '.parquet'))
+    size = os.path.getsize(path) if compressed else whole_lines(path)
+    digest = hashlib.sha1()
+    start = 0 if split_before is None else None
+    with open(path, 'rb') as fp:
+        def update(n):
+            for block in iter(lambda: fp.read(min(1 << 20, n - fp.tell())), b''):
+                digest.update(block)
+
+        if split_before is not None and split_before[0] <= size:
+            update(split_before[0])
+            if digest.hexdigest() == split_before[1] and (split_before[0] == size or not compressed):
+                start = split_before[0]
+        update(size)
+
+    return size, digest.hexdigest(), start
+
+def run_split(args, manifest):
+    """ Split the comments downloaded since the last split into new sets
+
+    Comments appended to a file, and new files, go into sets numbered after
+    the existing ones, which are left as they are. A rewritten comment file,
+    new settings, a changed --ids list or --force split everything again.
+    """
+    vids = video_ids(args.ids)
+    # partition files hold other videos' comments too, which a new id list may want
+    ids_hash = hashlib.sha1('\n'.join(sorted(set(vids))).encode('utf8')).hexdigest()
+    params = 'set_size=%d ids=%s' % (args.set_size, ids_hash)
+    state = manifest.get('split_sets', args.sets_dir)
+    full = args.force or state is None or state['params'] != params
+    files = {}
+    sources = []
+    for vid, path in comment_sources(args.comments_dir, vids):
+        if path in files:
+            continue
+        size, digest, start = scan_comments(path, None if full else manifest.get('split', path))
+        full = full or start is None
+        files[path] = [size, digest]
+        sources.append((vid, path, start, size))
+
+    if full:
+        sources = [(vid, path, 0, end) for vid, path, start, end in sources]
+        count = 0
+    else:
+        sources = [source for source in sources if source[2] < source[3]]
+        count = state['next']
+    if not sources:
+        print('No comments added since last split, skipping')
+        return
+
+    print('Splitting %d comment file(s) from set %d' % (len(set(source[1] for source in sources)), count))
+    count = split_comments(sources, args.sets_dir, args.set_size, count, args.chunksize, vids)
+    if full and state is not None:
+        # sets of the last split past the ones just written
+        for number in range(count, state['next']):
+            path = os.path.join(args.sets_dir, 'comments_set_%d.csv' % number)
+            if os.path.exists(path):
+                os.remove(path)
+    manifest.entries['split'] = files if full else dict(manifest.entries.get('split', {}), **files)
+    manifest.record('split_sets', args.sets_dir, {'params': params, 'next': count})
+
+def run_filter(args, manifest):
+    """ Language filter the comment sets that changed since they were last filtered """
+    params = 'model=%s lang=%s threshold=%s' % (args.model, args.lang, args.threshold)
+    digests = {}
+    for path in sorted(glob.glob(os.path.join(args.sets_dir, args.pattern))):
+        f = os.path.basename(path)
+        digests[f] = file_hash(path, params)
+    todo = [f for f in digests if args.force or not manifest.unchanged('filter', f, digests[f])
+            or not os.path.exists(os.path.join(args.filtered_dir, 'filtered_' + f))]
+    print('Filtering %d of %d comment set(s)' % (len(todo), len(digests)))
+    if not todo:
+        return
+
+    if not os.path.isdir(args.filtered_dir):
+        os.makedirs(args.filtered_dir)
+    directory = os.path.join(args.sets_dir, '')
+    done = lambda f: manifest.record('filter', f, digests[f])
+    if args.workers == 1:
+        model = fastText.load_model(args.model)
+        for f in todo:
+            print(f)
+            filter_file(f, args.lang, model, directory, args.threshold, args.batch_size, args.filtered_dir)
+            done(f)
+    else:
+        filter_lang_parallel(todo, args.lang, args.model, directory, args.workers or None,
+                             args.threshold, args.batch_size, args.filtered_dir, done)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Split downloaded comments into sets and filter them by language')
+    parser.add_argument('--stages', nargs='+', choices=['split', 'filter'], default=['split', 'filter'],
+                        help='Pipeline stages to run')
+    parser.add_argument('--ids', '-i', default='youtube-dl-archive.txt', help='File of video ids to split comments for')
+    parser.add_argument('--comments-dir', '-c', default='comments/', help='Directory of downloaded comment files')
+    parser.add_argument('--sets-dir', '-s', default='./', help='Directory for comment sets')
+    parser.add_argument('--filtered-dir', '-o', help='Directory for filtered sets (default: <sets-dir>/filtered)')
+    parser.add_argument('--pattern', '-p', default='comments_set_*.csv', help='Glob of comment sets to filter')
+    parser.add_argument('--model', '-m', default='lid.176.bin', help='fastText language identification model')
+    parser.add_argument('--lang', '-l', default='en', help='Language to keep')
+    parser.add_argument('--threshold', type=float, default=0.0, help='Minimum probability of the language to keep a comment')
+    parser.add_argument('--workers', '-w', type=int, default=0, help='Filter processes (0 for one per core)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Comments per fastText predict call')
+    parser.add_argument('--set-size', type=int, default=500, help='Comments per set')
+    parser.add_argument('--chunksize', type=int, default=10000, help='Lines read at once from a comment file')
+    parser.add_argument('--manifest', help='Manifest of processed inputs (default: <sets-dir>/.manifest.json)')
+    parser.add_argument('--force', action='store_true', help='Process inputs even if they are unchanged')
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.filtered_dir is None:
+        args.filtered_dir = os.path.join(args.sets_dir, 'filtered')
+    if args.manifest is None:
+        args.manifest = os.path.join(args.sets_dir, '.manifest.json')
+
+    return args
 
 def main():
     """main routine"""
+    args = get_args()
+    instrument.start(args)
+    manifest = Manifest(args.manifest)
+
     # Get the comments and turn them into tables
-    #get_comments('youtube-dl-archive.txt')
+    if 'split' in args.stages:
+        run_split(args, manifest)
 
     # Filter non-english seeming comments
-    lang_mod = fastText.load_model('lid.176.bin')
-    directory = '/Users/kristenbrown/Documents/GitHub/youtube-data/label-app/data/'
-    filter_lang(os.listdir('/Users/kristenbrown/Documents/GitHub/youtube-data/label-app/data/'), 'en', lang_mod, directory)
+    if 'filter' in args.stages:
+        run_filter(args, manifest)
     
     # Upload comments to SQL DB
 
 if __name__ == '__main__':
     main()
-
-
@@ -0,0 +1,168 @@
+""" Retry policy for crawler HTTP requests: backoff with jitter, Retry-After and circuit breaking """
+
+from __future__ import division
+
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+import requests
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+import instrument
+
+class RetryError(Exception):
+    """ A request still failed after all retries, or could not be retried """
+
+    def __init__(self, message, status_code=None):
+        super(RetryError, self).__init__(message)
+        self.status_code = status_code
+
+class RetryStats(object):
+    """ Thread-safe counters of retries and time spent sleeping, by failure kind """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retries = {}
+        self.sleep = {}
+        self.failures = 0
+
+    def record(self, kind, seconds):
+        with self.lock:
+            self.retries[kind] = self.retries.get(kind, 0) + 1
+            self.sleep[kind] = self.sleep.get(kind, 0.0) + seconds
+        instrument.add_time('retry_sleep', seconds)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'retries': dict(self.retries),
+                    'sleep_seconds': dict(self.sleep),
+                    'failures': self.failures}
+
+class CircuitBreaker(object):
+    """ Per-host breaker: after `threshold` failures in a row, hold all requests to the host
+
+    Once the cooldown is over requests go through again, but a single further
+    failure reopens the breaker, with the cooldown doubled up to `max_cooldown`.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def wait_time(self, host):
+        """ Seconds until requests to host may be sent """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return 0.0
+            return max(0.0, state['open_until'] - time.time())
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'open_until': 0.0, 'cooldown': self.cooldown})
+            state['failures'] += 1
+            if state['failures'] >= self.threshold:
+                state['open_until'] = time.time() + state['cooldown']
+                state['cooldown'] = min(self.max_cooldown, state['cooldown'] * 2)
+                # half open once the cooldown is over, one more failure reopens it
+                state['failures'] = self.threshold - 1
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delta seconds or HTTP date), or None """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+
+    return max(0.0, mktime_tz(date) - time.time())
+
+class RetryPolicy(object):
+    """ Decides whether and how long to wait before retrying a request
+
+    Throttling (429), server errors (5xx) and network errors each have their own
+    base delay. The wait is full jitter over a capped exponential backoff, unless
+    the server sent a Retry-After header. Other responses are not retried.
+
+    timeout is the (connect, read) timeout in seconds given to every attempt,
+    so a hung connection fails as a network error instead of blocking.
+    """
+
+    base_delay = {'throttled': 15.0, 'server': 2.0, 'network': 1.0}
+
+    def __init__(self, max_retries=8, cap=300.0, breaker=None, stats=None, rng=None, timeout=(10.0, 60.0)):
+        self.max_retries = max_retries
+        self.cap = cap
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = stats or RetryStats()
+        self.rng = rng or random.Random()
+
+    def backoff(self, kind, attempt, retry_after=None):
+        """ Seconds to sleep before retry number `attempt` (from 0) """
+        if retry_after is not None:
+            return min(self.cap, retry_after)
+        return self.rng.uniform(0, min(self.cap, self.base_delay[kind] * 2 ** attempt))
+
+    def classify(self, response):
+        """ Failure kind of a response, None when it should not be retried """
+        if response.status_code == 429:
+            return 'throttled'
+        if response.status_code >= 500:
+            return 'server'
+        return None
+
+    def request(self, send, url, limiter=None):
+        """ Call send(timeout) until it returns a 200 response, sleeping between attempts """
+        host = urlparse(url).netloc
+        for attempt in range(self.max_retries + 1):
+            wait = self.breaker.wait_time(host)
+            if wait:
+                self.stats.record('circuit_open', wait)
+                time.sleep(wait)
+            if limiter is not None:
+                limiter.acquire()
+
+            retry_after = None
+            try:
+                with instrument.timer('http'):
+                    response = send(self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                kind, error = 'network', str(e)
+            else:
+                if response.status_code == 200:
+                    self.breaker.success(host)
+                    return response
+                kind = self.classify(response)
+                error = 'HTTP %d from %s' % (response.status_code, url)
+                if kind is None:
+                    self.stats.record_failure()
+                    raise RetryError(error, response.status_code)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            self.breaker.failure(host)
+            if attempt == self.max_retries:
+                break
+            delay = self.backoff(kind, attempt, retry_after)
+            self.stats.record(kind, delay)
+            time.sleep(delay)
+
+        self.stats.record_failure()
+        raise RetryError('Giving up after %d retries: %s' % (self.max_retries, error))
@@ -0,0 +1,70 @@
+""" Local cache of comment scores, keyed by comment id, the model / vocab that scored it and where it was loaded """
+
+import hashlib
+import sqlite3
+import threading
+
+def file_hash(path):
+    """ SHA1 of a file's content """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+class ScoreCache(object):
+    """ SQLite table of (cid, model hash, vocab hash, target) -> mood probabilities
+
+    target names the table the scores were loaded into, so a comment cached
+    for one table is not taken as already loaded into another.
+    """
+
+    def __init__(self, path, model_hash, vocab_hash, moods, target=''):
+        self.model_hash = model_hash
+        self.vocab_hash = vocab_hash
+        self.target = target
+        self.moods = list(moods)
+        self.lock = threading.Lock()
+        # several scoring workers may share the file
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(scores)')]
+        if columns and 'target' not in columns:
+            # caches from before targets can't say where their scores were loaded
+            self.db.execute('DROP TABLE scores')
+        self.db.execute('CREATE TABLE IF NOT EXISTS scores ('
+                        'cid TEXT NOT NULL, model TEXT NOT NULL, vocab TEXT NOT NULL, target TEXT NOT NULL, %s, '
+                        'PRIMARY KEY (cid, model, vocab, target)) WITHOUT ROWID'
+                        % ', '.join('%s REAL' % mood for mood in self.moods))
+        self.db.commit()
+
+    def get(self, cids):
+        """ Dict of cid -> tuple of mood probabilities, for the cids that are cached """
+        hits = {}
+        cids = list(set(cids))
+        query = ('SELECT cid, %s FROM scores WHERE model = ? AND vocab = ? AND target = ? AND cid IN (%%s)'
+                 % ', '.join(self.moods))
+        with self.lock:
+            # stay under SQLite's default limit of 999 bound parameters
+            for start in range(0, len(cids), 900):
+                chunk = cids[start:start + 900]
+                rows = self.db.execute(query % ','.join('?' * len(chunk)),
+                                       [self.model_hash, self.vocab_hash, self.target] + chunk)
+                for row in rows:
+                    hits[row[0]] = tuple(row[1:])
+
+        return hits
+
+    def put(self, df):
+        """ Store the scores of a scored comment dataframe """
+        rows = [(str(cid), self.model_hash, self.vocab_hash, self.target) + tuple(float(p) for p in probs)
+                for cid, probs in zip(df['cid'], df[self.moods].values)]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO scores VALUES (%s)' % ','.join('?' * (4 + len(self.moods))),
+                                rows)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -7,18 +7,35 @@ from __future__ import print_function, division
 import pandas as pd
 import numpy as np
 import argparse
+import os
 import json
+import hashlib
+import itertools
+import collections
+import time
+import threading
+import multiprocessing
 import keras
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import examples.example_helper
 from deepmoji.sentence_tokenizer import SentenceTokenizer
 from deepmoji import attlayer
 from sqlalchemy import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy_utils import database_exists, create_database
+from bulk_loader import BulkLoader, db_url, ensure_column, loaded_sources
+from score_cache import ScoreCache, file_hash
+import instrument
+
+MOODS = ["annoyed", "joke", "calm", "excited"]
 
 def get_comment_table(filename):
     """ Loads a comment file as a dataframe """
-    df = pd.read_csv(filename, index_col=0)
+    with instrument.timer('read_csv'):
+        df = pd.read_csv(filename, index_col=0)
     return df
 
 def load_model(model_path):
@@ -27,15 +44,17 @@ def load_model(model_path):
     
     return model 
 
-def process_text(df, vocab):
+def process_text(df, vocab, st=None):
     """ Tokenizes the text for predictions """
     try:
         texts =  [unicode(x) for x in df['text']]
     except UnicodeDecodeError:
         texts = [x.decode('utf-8') for x in df['text']]
     
-    st = SentenceTokenizer(vocab, 30)
-    tokenized, _, _ = st.tokenize_sentences(texts)
+    if st is None:
+        st = SentenceTokenizer(vocab, 30)
+    with instrument.timer('tokenize'):
+        tokenized, _, _ = st.tokenize_sentences(texts)
 
     return tokenized
 
@@ -44,18 +63,176 @@ def top_scores(array, k):
     ind = np.argpartition(array, -k)[-k:]
     return ind[np.argsort(array[ind])][::-1]
 
-def score_text(tokenized, model, df):
+def score_text(tokenized, model, df, prob=None):
     """ Predicts text labels """
-    prob = model.predict(tokenized)
+    if prob is None:
+        prob = model.predict(tokenized)
     
-    df_prob = pd.DataFrame(prob, columns=["annoyed", "joke", "calm", "excited"])
-    df_final = pd.concat([df.reset_index(), df_prob], axis=1).drop('index',1)
+    df_prob = pd.DataFrame(prob, columns=MOODS)
+    df_final = pd.concat([df.reset_index(), df_prob], axis=1).drop(columns='index')
 
     return df_final
 
+class InferenceEngine(object):
+    """ Scores comment files with the model in large, length-bucketed batches
+
+    Files are read and tokenized on a background thread while the model
+    predicts, and the tokenizer is built once for the whole run. Comments of
+    consecutive files are pooled until there are pool_batches full batches,
+    sorted by length across files, predicted, and split back per file. Comments
+    found in the score cache are not predicted again: they are dropped, or
+    with keep_cached returned with their cached scores.
+    """
+
+    def __init__(self, model, vocab, batch_size=1024, maxlen=30, prefetch=4, cache=None, keep_cached=False,
+                 pool_batches=8):
+        self.model = model
+        self.vocab = vocab
+        self.batch_size = batch_size
+        self.st = SentenceTokenizer(vocab, maxlen)
+        self.prefetch = prefetch
+        self.cache = cache
+        self.keep_cached = keep_cached
+        self.maxlen = maxlen
+        self.pool_batches = pool_batches
+        # models built without a fixed input length can be fed trimmed batches
+        self.variable_length = model.input_shape[1] is None
+        self.comments = 0
+        self.cached = 0
+        self.predict_time = 0.0
+        self.start = None
+
+    def _produce(self, filenames, tokenized_q, skip_errors):
+        try:
+            for filename in filenames:
+                if filename is None:
+                    tokenized_q.put(('idle',))
+                    continue
+                try:
+                    df = get_comment_table(filename)
+                    df, cached = self.split_cached(df)
+                    if len(df):
+                        tokenized = process_text(df, self.vocab, self.st)
+                    else:
+                        tokenized = np.zeros((0, self.maxlen), dtype='uint16')
+                except Exception as e:
+                    if not skip_errors:
+                        raise
+                    tokenized_q.put(('error', filename, e))
+                    continue
+                tokenized_q.put(('file', filename, df, tokenized, cached))
+        except Exception as e:
+            tokenized_q.put(e)
+        tokenized_q.put(None)
+
+    def split_cached(self, df):
+        """ Separates comments with cached scores, returns (uncached df, cached df with scores) """
+        if self.cache is None or 'cid' not in df.columns:
+            return df, None
+        cids = df['cid'].astype(str)
+        hits = self.cache.get(cids.tolist())
+        if not hits:
+            return df, None
+        hit = cids.isin(hits).values
+        cached = df[hit].reset_index(drop=True)
+        prob = pd.DataFrame([hits[cid] for cid in cids[hit]], columns=MOODS)
+
+        return df[~hit], pd.concat([cached, prob], axis=1)
+
+    def predict(self, tokenized):
+        """ Model probabilities for tokenized comments, predicted in order of length """
+        if len(tokenized) == 0:
+            return np.zeros((0, len(MOODS)))
+        lengths = (tokenized != 0).sum(axis=1)
+        order = np.argsort(lengths, kind='mergesort')
+        prob = None
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            batch = tokenized[idx]
+            if self.variable_length:
+                batch = batch[:, :max(1, lengths[idx].max())]
+            with instrument.timer('predict'):
+                batch_prob = self.model.predict(batch, batch_size=self.batch_size)
+            instrument.count('predictions', len(batch))
+            if prob is None:
+                prob = np.zeros((len(tokenized), batch_prob.shape[1]), dtype=batch_prob.dtype)
+            prob[idx] = batch_prob
+
+        return prob
+
+    def run(self, filenames, on_error=None):
+        """ Yields (filename, scored dataframe) for each file, in order
+
+        A None among filenames means no more files are coming for now: the
+        pooled files are scored and yielded, then (None, None), so callers
+        fed from a queue can commit while they wait. on_error(filename, error)
+        is called for a file that can't be read, which is then skipped;
+        without on_error the error is raised.
+        """
+        tokenized_q = queue.Queue(self.prefetch)
+        producer = threading.Thread(target=self._produce, args=(filenames, tokenized_q, on_error is not None))
+        producer.daemon = True
+        producer.start()
+        self.start = time.time()
+        pooled = []
+        pooled_rows = 0
+
+        while True:
+            item = tokenized_q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item[0] == 'error':
+                on_error(item[1], item[2])
+            elif item[0] == 'idle':
+                for result in self._score_pool(pooled):
+                    yield result
+                pooled, pooled_rows = [], 0
+                yield None, None
+            else:
+                pooled.append(item[1:])
+                pooled_rows += len(item[3])
+                if pooled_rows >= self.batch_size * self.pool_batches:
+                    for result in self._score_pool(pooled):
+                        yield result
+                    pooled, pooled_rows = [], 0
+
+        for result in self._score_pool(pooled):
+            yield result
+
+    def _score_pool(self, pooled):
+        """ Predict the pooled files' comments together, yield (filename, scored dataframe) per file """
+        if not pooled:
+            return
+        start = time.time()
+        prob = self.predict(np.concatenate([tokenized for _, _, tokenized, _ in pooled]))
+        self.predict_time += time.time() - start
+
+        offset = 0
+        for filename, df, tokenized, cached in pooled:
+            self.comments += len(df)
+            df_final = score_text(tokenized, self.model, df, prob[offset:offset + len(df)])
+            offset += len(df)
+            if cached is not None:
+                self.cached += len(cached)
+                instrument.count('cache_hits', len(cached))
+                if self.keep_cached:
+                    df_final = pd.concat([df_final, cached], ignore_index=True, sort=False)
+            yield filename, df_final
+
+    def cache_scores(self, df_final):
+        """ Add the scores of a scored dataframe to the cache """
+        if self.cache is not None and 'cid' in df_final.columns and len(df_final):
+            self.cache.put(df_final)
+
+    def rate(self):
+        """ Comments scored per second so far """
+        return self.comments / max(time.time() - self.start, 1e-9) if self.start else 0.0
+
 def load_db(dbname, username):
     """ Creates a connection to my SQL database """
-    engine = create_engine('postgres://%s@localhost/%s'%(username,dbname))
+    engine = create_engine(db_url(dbname, username))
 
     if not database_exists(engine.url):
         create_database(engine.url)
@@ -64,15 +241,256 @@ def load_db(dbname, username):
     
     return engine, connection
 
+def open_cache(args):
+    """ Score cache for the model and vocab in args, None without --score-cache """
+    if not args.score_cache:
+        return None
+
+    # cached comments are skipped as already loaded, which only holds for the table they were loaded into
+    target = hashlib.sha1(('%s %s' % (db_url(args.database, args.user), args.table)).encode('utf8')).hexdigest()
+
+    return ScoreCache(args.score_cache, file_hash(args.model), file_hash(args.vocab), MOODS, target)
+
+def score_worker(worker_id, args, task_q, result_q):
+    """ Worker process: scores files from task_q with its own model and database connection
+
+    One inference run is fed from task_q for the worker's whole life, so
+    files are tokenized while earlier ones are predicted. Files are reported
+    'saved' only once their rows are committed, and 'error' if the batch
+    holding their rows could not be written. Each file is recorded in the
+    <table>_files sources table in the same transaction as its rows. The
+    worker's metrics are sent after every flush, for the parent to merge.
+    """
+    model = load_model(args.model)
+    with open(args.vocab, 'r') as f:
+        vocab = json.load(f)
+    engine = create_engine(db_url(args.database, args.user))
+    loader = BulkLoader(engine, args.table, args.load_batch, timestamp='scored_at', sources=args.table + '_files')
+    cache = open_cache(args)
+    inference = InferenceEngine(model, vocab, args.batch_size, cache=cache, keep_cached=args.keep_cached)
+    unsaved = []
+
+    def tasks():
+        while True:
+            try:
+                filename = task_q.get(timeout=1.0)
+            except queue.Empty:
+                # nothing to do right now, score and commit what is buffered
+                yield None
+                continue
+            if filename is None:
+                return
+            result_q.put(('started', worker_id, filename))
+            yield filename
+
+    def failed(filenames, e):
+        for filename in filenames:
+            result_q.put(('error', worker_id, filename, str(e)))
+
+    def lost(e):
+        # none of the unsaved files' rows were committed
+        failed([filename for filename, _ in unsaved], e)
+        loader.discard()
+        del unsaved[:]
+
+    def save():
+        try:
+            loader.flush()
+        except Exception as e:
+            lost(e)
+        else:
+            if unsaved:
+                result_q.put(('saved', worker_id, list(unsaved)))
+                del unsaved[:]
+        result_q.put(('metrics', worker_id, instrument.take()))
+
+    for filename, df_final in inference.run(tasks(), lambda filename, e: failed([filename], e)):
+        if filename is None:
+            save()
+            continue
+        unsaved.append((filename, len(df_final)))
+        try:
+            # cache scores only once they are in the database
+            loader.add(df_final, lambda df=df_final: inference.cache_scores(df), source=filename)
+        except Exception as e:
+            lost(e)
+            continue
+        if loader.pending_rows == 0:
+            # the loader just committed a batch, which covers every unsaved file
+            save()
+
+    save()
+    engine.dispose()
+    if cache is not None:
+        cache.close()
+
+def score_with_workers(args, filenames, progress_path, queued_per_worker=2):
+    """ Hands files to args.workers scoring processes, retrying the files of any that crash
+
+    Each worker has its own task queue, kept queued_per_worker files ahead of
+    it, so the files a worker was given and has not saved are known and go to
+    the other workers if it dies. A file its worker committed without living
+    to report it is found in the <table>_files sources table instead of being
+    loaded twice. Files are appended to progress_path once saved, and skipped
+    by later runs, as are files in the sources table.
+    """
+    try:
+        ctx = multiprocessing.get_context('spawn')
+    except AttributeError:
+        ctx = multiprocessing
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path) as fp:
+            done = set(line.strip() for line in fp)
+    engine = create_engine(db_url(args.database, args.user))
+    sources = args.table + '_files'
+    done.update(loaded_sources(engine, sources, [f for f in filenames if f not in done]))
+    todo = [f for f in filenames if f not in done]
+    print('%d of %d file(s) already scored' % (len(filenames) - len(todo), len(filenames)))
+
+    result_q = ctx.Queue()
+    pending = collections.deque(todo)
+    attempts = dict.fromkeys(todo, 0)
+    remaining = set(todo)
+    failed = []
+    workers = {}
+    task_qs = {}
+    # files given to each worker and not saved yet, and how many it has not started
+    assigned = {}
+    queued = {}
+    worker_ids = itertools.count()
+    restarts = 0
+    comments = 0
+    start = time.time()
+
+    def spawn():
+        worker_id = next(worker_ids)
+        task_qs[worker_id] = ctx.Queue()
+        worker = ctx.Process(target=score_worker, args=(worker_id, args, task_qs[worker_id], result_q))
+        worker.daemon = True
+        worker.start()
+        workers[worker_id] = worker
+        assigned[worker_id] = []
+        queued[worker_id] = 0
+
+    def feed(worker_id):
+        while pending and queued[worker_id] < queued_per_worker:
+            filename = pending.popleft()
+            task_qs[worker_id].put(filename)
+            assigned[worker_id].append(filename)
+            queued[worker_id] += 1
+
+    def saved(filename):
+        remaining.discard(filename)
+        progress.write(filename + '\n')
+        print('Processed file: %s' % filename)
+
+    def retry(filename):
+        if attempts[filename] and loaded_sources(engine, sources, [filename]):
+            # its worker died between the commit and reporting it
+            saved(filename)
+        elif attempts[filename] < args.max_attempts:
+            pending.append(filename)
+        else:
+            failed.append(filename)
+            remaining.discard(filename)
+
+    def handle(msg):
+        kind, worker_id = msg[0], msg[1]
+        if kind == 'metrics':
+            # the work was done even if the worker died since
+            instrument.merge(msg[2])
+            return 0
+        if worker_id not in workers:
+            # from a worker already given up as dead, its files were retried
+            return 0
+        if kind == 'started':
+            queued[worker_id] -= 1
+            attempts[msg[2]] += 1
+        elif kind == 'saved':
+            for filename, n in msg[2]:
+                assigned[worker_id].remove(filename)
+                saved(filename)
+            progress.flush()
+            return sum(n for _, n in msg[2])
+        elif kind == 'error':
+            print('Failed to score file %s: %s' % (msg[2], msg[3]))
+            assigned[worker_id].remove(msg[2])
+            retry(msg[2])
+        return 0
+
+    for _ in range(min(args.workers, len(todo))):
+        spawn()
+
+    with open(progress_path, 'a') as progress:
+        while remaining:
+            for worker_id in workers:
+                feed(worker_id)
+            try:
+                comments += handle(result_q.get(timeout=1.0))
+            except queue.Empty:
+                pass
+
+            for worker_id, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+                # take in anything it reported before dying, then retry the rest
+                while True:
+                    try:
+                        comments += handle(result_q.get_nowait())
+                    except queue.Empty:
+                        break
+                print('Worker %d died (exit code %s), retrying %d file(s)'
+                      % (worker_id, worker.exitcode, len(assigned[worker_id])))
+                del workers[worker_id]
+                task_qs.pop(worker_id).cancel_join_thread()
+                for filename in assigned.pop(worker_id):
+                    retry(filename)
+                restarts += 1
+                if restarts > args.max_attempts * args.workers:
+                    raise RuntimeError('Scoring workers keep dying, giving up')
+                if remaining:
+                    spawn()
+
+        for worker_id in workers:
+            task_qs[worker_id].put(None)
+        # take in the workers' last metrics as they finish
+        while any(worker.is_alive() for worker in workers.values()):
+            try:
+                handle(result_q.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                handle(result_q.get_nowait())
+            except queue.Empty:
+                break
+    for worker in workers.values():
+        worker.join()
+    engine.dispose()
+
+    print('Scored %d comments with %d worker(s), %.1f comments/sec'
+          % (comments, args.workers, comments / max(time.time() - start, 1e-9)))
+    if failed:
+        print('Could not score %d file(s): %s' % (len(failed), ', '.join(failed)))
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', '-m', help='Path to model for prediction', required=True)
     parser.add_argument('--vocab', '-v', help='Path to vocab file for model', required=True)
-    parser.add_argument('--database', '-d', help='Name of database to load', required=True)
+    parser.add_argument('--database', '-d', help='Name of database to load, or a SQLAlchemy URL', required=True)
     parser.add_argument('--table', '-t', help='Table to add comments to', required=True)
-    parser.add_argument('--user', '-u', help='Username for database connection', required=True)
+    parser.add_argument('--user', '-u', help='Username for database connection (unless --database is a URL)')
     parser.add_argument('--comments', '-c', help='File of filenames with comments to score', required=True)
+    parser.add_argument('--load-batch', type=int, default=50000, help='Rows written per database transaction')
     parser.add_argument('--directory', '-f', help='Directory containing files if not in --comments file')
+    parser.add_argument('--batch-size', '-b', type=int, default=1024, help='Comments per model.predict batch')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Scoring processes, each with its own model')
+    parser.add_argument('--progress-file', help='File listing scored files, for --workers (default: <comments>.done)')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Times a file is tried before it is given up')
+    parser.add_argument('--score-cache', help='SQLite file of scores by comment id, model, vocab and target table; cached comments are skipped')
+    parser.add_argument('--keep-cached', action='store_true', help='Load cached comments again with their cached scores')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -81,11 +499,7 @@ def get_args():
 def main():
     
     args = get_args()
-    model = load_model(args.model)
-    engine, connection = load_db(args.database, args.user)
-
-    with open(args.vocab, 'r') as f:
-        vocab = json.load(f)
+    instrument.start(args)
 
     if args.directory:
         directory = args.directory
@@ -93,23 +507,41 @@ def main():
         directory = './'
     
     with open(args.comments) as com_files:
-        for com in com_files:
-            # load comments
-            df = get_comment_table(directory+com.strip())
+        filenames = [directory+com.strip() for com in com_files if com.strip()]
+
+    if args.workers > 1:
+        # make sure the database exists before the workers connect
+        engine, connection = load_db(args.database, args.user)
+        ensure_column(engine, args.table, 'scored_at', 'TIMESTAMP')
+        connection.close()
+        engine.dispose()
+        score_with_workers(args, filenames, args.progress_file or args.comments + '.done')
+        return
+
+    model = load_model(args.model)
+    engine, connection = load_db(args.database, args.user)
 
-            # predict class
-            tokenized = process_text(df, vocab)
-            df_final = score_text(tokenized, model, df)
+    with open(args.vocab, 'r') as f:
+        vocab = json.load(f)
 
-            # add to db
-            df_final.to_sql(args.table, con=connection, if_exists='append', index=False)
-            
-            print('Processed file: %s' % com)
+    # score_videos --incremental picks up comments by when they were scored
+    ensure_column(engine, args.table, 'scored_at', 'TIMESTAMP')
+    loader = BulkLoader(engine, args.table, args.load_batch, timestamp='scored_at')
+    cache = open_cache(args)
+    inference = InferenceEngine(model, vocab, args.batch_size, cache=cache, keep_cached=args.keep_cached)
+    for filename, df_final in inference.run(filenames):
+        # add to db, then cache the scores once they are committed
+        loader.add(df_final, lambda df=df_final: inference.cache_scores(df))
+        
+        print('Processed file: %s (%.1f comments/sec)' % (filename, inference.rate()))
 
+    loader.close()
+    print('Scored %d comments, %.1f comments/sec overall, %.1f comments/sec in predict'
+          % (inference.comments, inference.rate(), inference.comments / max(inference.predict_time, 1e-9)))
+    if cache is not None:
+        print('%d comment(s) already scored by this model, skipped' % inference.cached)
+        cache.close()
     connection.close()
 
 if __name__ == '__main__':
     main()
-
-
-
@@ -3,32 +3,53 @@
 
 import os
 import argparse
+import datetime
 import json
 import pandas as pd
-import numpy as np
 import psycopg2
 import sqlalchemy
 from collections import Counter
-from sqlalchemy import Table, MetaData, create_engine
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from sqlalchemy import create_engine
 from sqlalchemy_utils import database_exists, create_database
+from bulk_loader import BulkLoader, db_url, ensure_column, has_table, delete_keys
+import video_schema
+import instrument
 
-def get_metadata(filename):
-    with open(filename) as mtda:
-        metadata = json.load(mtda)
-    
-    metadata = pd.DataFrame.from_dict(metadata, orient='index')
+MOODS = ['annoyed', 'joke', 'calm', 'excited']
+
+KEEPERS = ['id', 'uploader', 'uploader_id', 'uploader_url', 'channel_id', 'channel_url',
+           'upload_date', 'title', 'thumbnail', 'description', 'categories', 'tags',
+           'duration', 'age_limit', 'view_count', 'like_count', 'dislike_count', 'average_rating']
+
+def read_metadata(filename):
+    """ The kept fields of a youtube-dl info JSON file, as a tuple in KEEPERS order """
+    with open(filename, 'rb') as mtda:
+        data = mtda.read()
+    metadata = orjson.loads(data) if orjson is not None else json.loads(data.decode('utf8'))
 
-    keepers = ['id', 'uploader', 'uploader_id', 'uploader_url', 'channel_id', 'channel_url',
-          'upload_date', 'title', 'thumbnail', 'description', 'categories', 'tags',
-          'duration', 'age_limit', 'view_count', 'like_count', 'dislike_count', 'average_rating']
-        
-    clean_metadata = metadata.loc[keepers].transpose()
+    return tuple(metadata.get(key) for key in KEEPERS)
 
-    return clean_metadata
+def metadata_frame(records, index=None):
+    """ Dataframe of read_metadata records with numeric and date columns typed """
+    if not records:
+        # from_records takes the index as field names when there are no records
+        metadata = pd.DataFrame(columns=KEEPERS, index=pd.Index(index or []))
+    else:
+        metadata = pd.DataFrame.from_records(records, columns=KEEPERS, index=index)
+
+    return video_schema.coerce_columns(metadata)
+
+def get_metadata(filename):
+    return metadata_frame([read_metadata(filename)])
 
 def load_db(dbname, username):
     """ Creates a connection to my SQL database """
-    engine = create_engine('postgres://%s@localhost/%s'%(username,dbname))
+    engine = create_engine(db_url(dbname, username))
 
     if not database_exists(engine.url):
         create_database(engine.url)
@@ -37,55 +58,139 @@ def load_db(dbname, username):
     
     return engine, connection
 
-def get_vid_comments(video_id, engine):
-    """ Return comments for a particular video """
-    m = MetaData()
-    comments = Table('comments', m, autoload=True, autoload_with=engine)
-    video_coms = sqlalchemy.select([comments]).where(comments.columns.video_id == video_id)
-    video_coms_df = pd.read_sql(video_coms, engine)
+def get_all_metadata(directory, vid_files, workers=8):
+    """ Metadata of every video file in one dataframe, indexed by file name
 
-    return video_coms_df
+    Files are read by `workers` threads, which keeps many reads in flight on a
+    cold directory; parsing only takes a fraction of that with orjson.
+    """
+    vid_files = [vid.strip() for vid in vid_files]
+    paths = [os.path.join(directory, vid) for vid in vid_files]
+    with instrument.timer('read_metadata'):
+        if workers <= 1:
+            records = [read_metadata(path) for path in paths]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                records = list(executor.map(read_metadata, paths))
+    instrument.count('metadata_files', len(records))
 
-def sel_class(num, prob):
-    """ Set num to 1 with with sufficient probability """
-    if num < prob:
-        return 0
-    else:
-        return 1
-
-def agg_scores(df, prob):
-    """ Aggregate predictions in a df """
-
-    # sum all within each class
-    annoyed = np.sum(df['annoyed'].apply(lambda x: sel_class(x,prob)))
-    joke = np.sum(df['joke'].apply(lambda x: sel_class(x,prob)))
-    calm = np.sum(df['calm'].apply(lambda x: sel_class(x,prob)))
-    excited = np.sum(df['excited'].apply(lambda x: sel_class(x,prob)))
-    all_moods = sum([annoyed, joke, calm, excited])
-    if all_moods != 0:
-        scores = {'annoyed': annoyed / all_moods, 
-                  'joke': joke / all_moods, 
-                  'calm': calm / all_moods ,
-                  'excited': excited / all_moods}
-    else:
-        scores = {'annoyed': annoyed, 
-                  'joke': joke, 
-                  'calm': calm,
-                  'excited': excited}
+    return metadata_frame(records, index=vid_files)
+
+def mood_count_query(engine, comments_table, since=None, until=None):
+    """ Per video count of comments with each mood's probability at least :prob
+
+    Only comments scored after `since` and up to `until` are counted, when given.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    counts = ', '.join('SUM(CASE WHEN %s >= :prob THEN 1 ELSE 0 END) AS %s' % (quote(mood), quote(mood))
+                       for mood in MOODS)
+    where = []
+    params = [sqlalchemy.bindparam('prob')]
+    if since is not None:
+        where.append('scored_at > :since')
+        params.append(sqlalchemy.bindparam('since', type_=sqlalchemy.DateTime))
+    if until is not None:
+        # comments loaded before scored_at existed are counted by full runs
+        where.append('(scored_at <= :until%s)' % (' OR scored_at IS NULL' if since is None else ''))
+        params.append(sqlalchemy.bindparam('until', type_=sqlalchemy.DateTime))
+    where = ' WHERE ' + ' AND '.join(where) if where else ''
+
+    return sqlalchemy.text('SELECT video_id, %s FROM %s%s GROUP BY video_id'
+                           % (counts, quote(comments_table), where)).bindparams(*params)
+
+def get_mood_counts(engine, comments_table, prob, since=None, until=None):
+    """ Thresholded mood counts of all videos, aggregated in the database in one query """
+    params = {'prob': prob}
+    if since is not None:
+        params['since'] = since
+    if until is not None:
+        params['until'] = until
+    with instrument.timer('mood_counts'):
+        counts = pd.read_sql(mood_count_query(engine, comments_table, since, until), engine, params=params)
+
+    return counts.set_index('video_id')[MOODS].fillna(0).astype(int)
+
+def latest_scored_at(engine, comments_table, settle):
+    """ Newest scored_at at least `settle` seconds old, None if there is none
 
-    return scores
+    Comments newer than that may belong to batches still being committed.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    query = sqlalchemy.text('SELECT MAX(scored_at) AS latest FROM %s WHERE scored_at <= :cutoff'
+                            % quote(comments_table))
+    query = query.bindparams(sqlalchemy.bindparam('cutoff', type_=sqlalchemy.DateTime))
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=settle)
+    latest = pd.read_sql(query, engine, params={'cutoff': cutoff}, parse_dates=['latest'])['latest'][0]
 
-def add_scores(df, scores):
-    """ Add aggregated scores to metadata df """
-    for key, val in scores.items():
-        ind = key + '_score'
-        df[ind] = val
+    return None if pd.isnull(latest) else latest.to_pydatetime()
 
-    return df 
+def get_watermark(engine, summary_table, prob):
+    """ scored_at up to which the summary table has counted comments, None to rebuild it """
+    watermark_table = summary_table + '_watermark'
+    if not has_table(engine, watermark_table):
+        return None
+    state = pd.read_sql_table(watermark_table, engine, parse_dates=['scored_at'])
+    if len(state) != 1 or state['prob'][0] != prob or pd.isnull(state['scored_at'][0]):
+        # counts above a different threshold can't be added to
+        return None
+
+    return state['scored_at'][0].to_pydatetime()
+
+def get_summary(engine, summary_table, video_ids):
+    """ Running mood counts of some videos from the summary table, zero for new videos """
+    counts = pd.DataFrame(0, index=pd.Index(video_ids, name='video_id'), columns=MOODS)
+    if len(counts) == 0 or not has_table(engine, summary_table):
+        return counts
+    quote = engine.dialect.identifier_preparer.quote
+    query = sqlalchemy.text('SELECT video_id, %s FROM %s WHERE video_id IN :ids'
+                            % (', '.join(quote(mood) for mood in MOODS), quote(summary_table)))
+    query = query.bindparams(sqlalchemy.bindparam('ids', expanding=True))
+    ids = list(counts.index)
+    for start in range(0, len(ids), 900):
+        stored = pd.read_sql(query, engine, params={'ids': ids[start:start + 900]}).set_index('video_id')
+        counts.loc[stored.index, MOODS] = stored[MOODS].values
+
+    return counts
+
+def save_summary(engine, summary_table, counts, watermark, prob, replace=False):
+    """ Upsert running counts and move the watermark, in one transaction
+
+    With replace, the summary table is rebuilt from counts.
+    """
+    df = counts.reset_index()
+    with engine.begin() as connection:
+        if engine.dialect.has_table(connection, summary_table):
+            if replace:
+                connection.execute(sqlalchemy.text('DELETE FROM %s'
+                                                   % engine.dialect.identifier_preparer.quote(summary_table)))
+            else:
+                delete_keys(connection, summary_table, 'video_id', df['video_id'])
+        df.to_sql(summary_table, con=connection, if_exists='append', index=False,
+                  method='multi', chunksize=999 // len(df.columns))
+        state = pd.DataFrame({'scored_at': [watermark], 'prob': [prob]})
+        state.to_sql(summary_table + '_watermark', con=connection, if_exists='replace', index=False)
+
+def get_video_ids(engine, table):
+    """ Ids of the videos already in the video table """
+    if not has_table(engine, table):
+        return set()
+
+    return set(pd.read_sql_table(table, engine, columns=['id'])['id'])
+
+def normalize_scores(counts):
+    """ Mood counts as fractions of each video's total, <mood>_score columns """
+    total = counts[MOODS].sum(axis=1)
+    scores = counts[MOODS].div(total.where(total != 0, 1), axis=0)
+
+    return scores.rename(columns=dict((mood, mood + '_score') for mood in MOODS))
 
 def get_top_tagword(df):
-    tags = df['tags'].values[0]
+    return top_tagword(df['tags'].values[0])
 
+def top_tagword(tags):
+    """ Most common word in a video's tags, None without tags """
+    if tags is None:
+        return None
     if isinstance(tags, list):
         tags = ' '.join(tags)
 
@@ -93,16 +198,27 @@ def get_top_tagword(df):
     tags = tags.replace('\"','').replace('}','')
     tags = tags.split()
     tag_counts = Counter(tags)
+    if not tag_counts:
+        return None
 
     return tag_counts.most_common(1)[0][0]
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--database', '-d', help='Name of database to load', required=True)
+    parser.add_argument('--database', '-d', help='Name of database to load, or a SQLAlchemy URL', required=True)
     parser.add_argument('--table', '-t', help='Table to add videos to', required=True)
-    parser.add_argument('--user', '-u', help='Username for database connection', required=True)
+    parser.add_argument('--user', '-u', help='Username for database connection (unless --database is a URL)')
     parser.add_argument('--comments', '-c', help='Table containing comments', required=True)
+    parser.add_argument('--load-batch', type=int, default=50000, help='Rows written per database transaction')
     parser.add_argument('--directory', '-f', help='Directory containing files if not current directory')
+    parser.add_argument('--prob', type=float, default=0.75, help='Probability for a comment to count towards a mood')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Only rescore videos with comments scored since the last run, and new videos')
+    parser.add_argument('--summary-table', help='Table of running mood counts per video (default: <table>_mood_counts)')
+    parser.add_argument('--workers', '-w', type=int, default=8, help='Threads reading metadata files')
+    parser.add_argument('--settle', type=float, default=60,
+                        help='Seconds before newly scored comments are counted, so batches in flight are not missed')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -111,6 +227,7 @@ def get_args():
 def main():
     
     args = get_args()
+    instrument.start(args)
     engine, connection = load_db(args.database, args.user)
 
     if args.directory:
@@ -118,24 +235,58 @@ def main():
     else:
         directory = './'
     
-    vid_files = os.listdir(directory)
-
-    for vid in vid_files:
-        # load comments
-        df = get_metadata(directory+vid.strip())
-        df_coms = get_vid_comments(vid, engine)
-
-        # predict class
-        scores = agg_scores(df_coms, 0.75)
-        df_final = add_scores(df, scores)
-
-        # get top keyword in tags
-        df_final['top_tag'] = get_top_tagword(df)
-        
-        # add to db
-        df_final.to_sql(args.table, con=connection, if_exists='append', index=False)
-        
-        print('Processed video: %s' % vid)
+    summary_table = args.summary_table or args.table + '_mood_counts'
+    ensure_column(engine, args.comments, 'scored_at', 'TIMESTAMP')
+    until = latest_scored_at(engine, args.comments, args.settle)
+    since = get_watermark(engine, summary_table, args.prob) if args.incremental else None
+    if args.incremental and since is None:
+        print('No usable watermark in %s, scoring all videos' % summary_table)
+
+    vid_files = [vid.strip() for vid in os.listdir(directory)]
+    if since is not None:
+        # add the counts of newly scored comments to the running counts
+        until = max(since, until or since)
+        new_counts = get_mood_counts(engine, args.comments, args.prob, since, until)
+        known = get_video_ids(engine, args.table)
+        new_videos = [vid for vid in vid_files if vid not in known]
+        # videos new to the video table may have comments counted by earlier runs
+        summary = get_summary(engine, summary_table, new_counts.index.union(new_videos))
+        summary = summary[summary[MOODS].sum(axis=1) > 0]
+        counts = summary.add(new_counts, fill_value=0)
+        vid_files = [vid for vid in vid_files if vid in new_counts.index or vid not in known]
+        scored = counts
+    else:
+        # one GROUP BY over the comments table for all videos
+        counts = get_mood_counts(engine, args.comments, args.prob, until=until)
+        scored = counts
+        if until is not None:
+            # comments past the watermark count towards the scores too, and go
+            # into the summary with the next incremental run
+            late = get_mood_counts(engine, args.comments, args.prob, since=until)
+            scored = counts.add(late, fill_value=0).astype(int)
+    metadata = get_all_metadata(directory, vid_files, args.workers)
+
+    if len(metadata):
+        scores = normalize_scores(scored).reindex(metadata.index).fillna(0)
+        df_final = pd.concat([metadata, scores], axis=1)
+
+        # get top keyword in tags, and the normalized top tags the app matches topics on
+        df_final['top_tag'] = df_final['tags'].map(top_tagword)
+        df_final['top_tags'] = df_final['tags'].map(video_schema.normalize_tags)
+
+        # upsert into db, then record the counts so a crash in between only repeats this run
+        video_schema.create(engine, args.table)
+        loader = BulkLoader(engine, args.table, args.load_batch, key='id')
+        for start in range(0, len(df_final), args.load_batch):
+            loader.add(df_final.iloc[start:start + args.load_batch])
+        loader.close()
+        video_schema.load_tags(engine, args.table + '_tags', df_final, args.load_batch)
+    save_summary(engine, summary_table, counts, until, args.prob, replace=since is None)
+    if len(metadata):
+        # tells the app its cached recommendations are out of date
+        video_schema.bump_version(engine, args.table)
+
+    print('Processed %d video(s), %d with comments' % (len(metadata), metadata.index.isin(scored.index).sum()))
 
 if __name__ == '__main__':
     main()
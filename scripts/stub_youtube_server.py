@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+""" Local stand-in for the YouTube comment pages, for crawling offline """
+
+from __future__ import print_function
+
+import json
+import time
+import random
+import argparse
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+COMMENT_HTML = ('<div class="comment-item" data-cid="{cid}">'
+                '<span class="user-name">{author}</span>'
+                '<span class="time"> {time} </span>'
+                '<div class="comment-text-content">{text}</div>'
+                '{likes}{dislikes}{replies}</div>')
+
+WORDS = ['so', 'good', 'yummy', 'lol', 'this', 'recipe', 'is', 'the', 'best',
+         'why', 'would', 'you', 'do', 'that', 'love', 'it', 'wow', 'cake']
+
+class StubConfig(object):
+    """ Shape of the fake comment section served for every video """
+
+    def __init__(self, pages=5, per_page=20, replies=3, reply_every=5, latency=0.0, seed=0,
+                 error_rate=0.0, retry_after=1, fail_first=0):
+        self.pages = pages
+        self.per_page = per_page
+        self.replies = replies
+        self.reply_every = reply_every
+        self.latency = latency
+        self.seed = seed
+        # share of requests answered with 429 / 503 to exercise retries
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        # the first requests are answered 503 and 429 in turn, a burst of failures
+        self.fail_first = fail_first
+        # (arrival time, status) of every request the server answered
+        self.served = []
+        self.lock = threading.Lock()
+
+    def status(self):
+        """ Status to answer the next request with, logged with its arrival time """
+        with self.lock:
+            n = len(self.served)
+            if n < self.fail_first:
+                status = [503, 429][n % 2]
+            elif self.error_rate and random.random() < self.error_rate:
+                status = random.choice([429, 503])
+            else:
+                status = 200
+            self.served.append((time.time(), status))
+
+        return status
+
+def render_comment(cid, rng, reply_header=False):
+    """ HTML for one comment, optionally with a 'View all replies' link """
+    likes = rng.randint(0, 50)
+    dislikes = rng.randint(0, 5)
+    replies = ''
+    if reply_header:
+        replies = ('<div class="comment-replies-header">'
+                   '<div class="load-comments" data-cid="%s"></div></div>' % cid)
+    return COMMENT_HTML.format(cid=cid,
+                               author='user_%d' % rng.randint(0, 10000),
+                               time='%d days ago' % rng.randint(1, 300),
+                               text=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+                               likes='<span class="like-count">%d</span>' % likes if likes else '',
+                               dislikes='<span class="dislike-count">%d</span>' % dislikes if dislikes else '',
+                               replies=replies)
+
+def render_page(youtube_id, page, config):
+    """ HTML for one page of top level comments """
+    rng = random.Random('%s-%s-%d' % (config.seed, youtube_id, page))
+    items = []
+    for i in range(config.per_page):
+        n = page * config.per_page + i
+        items.append(render_comment('%s.%d' % (youtube_id, n), rng,
+                                    config.reply_every and n % config.reply_every == 0))
+    return ''.join(items)
+
+def render_replies(comment_id, config):
+    """ HTML for the replies to one comment """
+    rng = random.Random('%s-%s' % (config.seed, comment_id))
+    return ''.join(render_comment('%s.r%d' % (comment_id, i), rng) for i in range(config.replies))
+
+def next_token(page, config):
+    return str(page + 1) if page + 1 < config.pages else None
+
+def render_watch_page(youtube_id, config):
+    """ The all_comments page with first comments and tokens """
+    token = next_token(0, config)
+    return ('<html><head><script>var cfg = {\'XSRF_TOKEN\': "stub-xsrf-%s"};</script></head>'
+            '<body><div id="comments">%s</div>%s</body></html>'
+            % (youtube_id, render_page(youtube_id, 0, config),
+               '<button data-token="%s"></button>' % token if token else ''))
+
+def make_handler(config):
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, content_type='text/html'):
+            status = config.status()
+            if config.latency:
+                threading.Event().wait(config.latency)
+            if status != 200:
+                self.send_response(status)
+                self.send_header('Retry-After', str(config.retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = body.encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/all_comments':
+                self.send_error(404)
+                return
+            youtube_id = parse_qs(url.query).get('v', [''])[0]
+            self._send(render_watch_page(youtube_id, config))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/comment_ajax':
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            length = int(self.headers.get('Content-Length', 0))
+            data = parse_qs(self.rfile.read(length).decode('utf8'))
+            youtube_id = data.get('video_id', [''])[0]
+
+            if 'action_load_replies' in params:
+                response = {'html_content': render_replies(data['comment_id'][0], config)}
+            else:
+                page = int(data.get('page_token', ['0'])[0])
+                response = {'html_content': render_page(youtube_id, page, config)}
+                token = next_token(page, config)
+                if token:
+                    response['page_token'] = token
+            self._send(json.dumps(response), 'application/json')
+
+    return StubHandler
+
+class StubResponse(object):
+
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+class StubSession(object):
+    """ Drop-in for requests.Session answering from the stub pages in process, no sockets """
+
+    def __init__(self, config=None):
+        self.config = config or StubConfig()
+        self.headers = {}
+
+    def get(self, url, **kwargs):
+        youtube_id = parse_qs(urlparse(url).query).get('v', [''])[0]
+        return StubResponse(render_watch_page(youtube_id, self.config))
+
+    def post(self, url, params=None, data=None, **kwargs):
+        if 'action_load_replies' in params:
+            return StubResponse(json.dumps({'html_content': render_replies(data['comment_id'], self.config)}))
+        page = int(data.get('page_token', 0))
+        response = {'html_content': render_page(data['video_id'], page, self.config)}
+        token = next_token(page, self.config)
+        if token:
+            response['page_token'] = token
+        return StubResponse(json.dumps(response))
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port=0, config=None):
+    """ Start the stub server on a background thread, returns (server, base_url) """
+    server = ThreadingServer(('127.0.0.1', port), make_handler(config or StubConfig()))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Serve fake YouTube comment pages for offline crawling')
+    parser.add_argument('--port', '-p', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--pages', type=int, default=5, help='Pages of top level comments per video')
+    parser.add_argument('--per-page', type=int, default=20, help='Comments per page')
+    parser.add_argument('--replies', type=int, default=3, help='Replies per comment with replies')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 429/503')
+    parser.add_argument('--fail-first', type=int, default=0, help='Requests answered with 503/429 before any succeed')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    config = StubConfig(pages=args.pages, per_page=args.per_page,
+                        replies=args.replies, latency=args.latency, error_rate=args.error_rate,
+                        fail_first=args.fail_first)
+    server = ThreadingServer(('127.0.0.1', args.port), make_handler(config))
+    print('Serving stub comments on http://127.0.0.1:%d' % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+""" Typed, indexed schema for the video table, and a migration from the old text columns """
+
+from __future__ import print_function, division
+
+import argparse
+from collections import Counter
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import Table, Column, MetaData, Index, Text, Date, BigInteger, Float, create_engine
+from bulk_loader import BulkLoader, db_url, has_table, delete_keys, ensure_column
+
+MOODS = ['annoyed', 'joke', 'calm', 'excited']
+
+INT_COLUMNS = ['duration', 'age_limit', 'view_count', 'like_count', 'dislike_count']
+FLOAT_COLUMNS = ['average_rating'] + [mood + '_score' for mood in MOODS]
+DATE_COLUMNS = ['upload_date']
+# tags, categories and top_tags are PostgreSQL array text
+TEXT_COLUMNS = ['uploader', 'uploader_id', 'uploader_url', 'channel_id', 'channel_url',
+                'title', 'thumbnail', 'description', 'categories', 'tags', 'top_tag', 'top_tags']
+
+def video_table(name, metadata=None, indexes=True):
+    """ SQLAlchemy Table for the video table, with an index per mood score
+
+    The app orders by one mood score and takes the first 100 rows, so each
+    score has a descending index it can read in order instead of sorting. The
+    filter columns follow the score in the index, so rows are filtered from
+    the index entries. Indexes on the filter columns alone are left out: the
+    filter ranges are wide, and planners that pick them end up sorting most
+    of the table.
+    """
+    metadata = metadata if metadata is not None else MetaData()
+    columns = [Column('id', Text, primary_key=True)]
+    columns += [Column(c, Text) for c in TEXT_COLUMNS]
+    columns += [Column(c, BigInteger) for c in INT_COLUMNS]
+    columns += [Column(c, Float) for c in FLOAT_COLUMNS]
+    columns += [Column(c, Date) for c in DATE_COLUMNS]
+    table = Table(name, metadata, *columns)
+    if not indexes:
+        return table
+
+    for mood in MOODS:
+        Index('ix_%s_%s_score' % (name, mood), table.c[mood + '_score'].desc(),
+              table.c.duration, table.c.view_count, table.c.upload_date)
+
+    return table
+
+def tags_table(name, metadata=None):
+    """ Inverted index from each normalized top tag to the videos that have it """
+    metadata = metadata if metadata is not None else MetaData()
+    table = Table(name, metadata,
+                  Column('tag', Text, primary_key=True),
+                  Column('video_id', Text, primary_key=True))
+    Index('ix_%s_video_id' % name, table.c.video_id)
+
+    return table
+
+def normalize_tags(tags, n=5):
+    """ The n most common lowercase words of a video's tags, a list or array text """
+    if tags is None:
+        return []
+    if isinstance(tags, list):
+        tags = ' '.join(tags)
+
+    tags = tags.replace(',',' ').replace('{', '').replace('(','')
+    tags = tags.replace('\"','').replace('}','').replace(')','')
+    tags = tags.lower()
+    tags = tags.split()
+
+    return [x[0] for x in Counter(tags).most_common(n)]
+
+def tag_postings(df):
+    """ (tag, video_id) rows for a frame of videos with a top_tags column """
+    postings = pd.DataFrame([(tag, video_id) for video_id, tags in zip(df['id'], df['top_tags'])
+                             for tag in tags], columns=['tag', 'video_id'])
+
+    return postings.drop_duplicates()
+
+def load_tags(engine, name, df, batch_rows=50000):
+    """ Replace the postings of the videos in df with their current top tags """
+    tags_table(name).create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        delete_keys(connection, name, 'video_id', df['id'])
+    loader = BulkLoader(engine, name, batch_rows)
+    postings = tag_postings(df)
+    for start in range(0, len(postings), batch_rows):
+        loader.add(postings.iloc[start:start + batch_rows])
+    loader.close()
+
+def versions_table(metadata=None):
+    """ Version number per table, bumped whenever the table's scores are rewritten """
+    metadata = metadata if metadata is not None else MetaData()
+
+    return Table('data_versions', metadata,
+                 Column('name', Text, primary_key=True),
+                 Column('version', BigInteger, nullable=False))
+
+def bump_version(engine, name):
+    """ Move a table to its next version, so caches of its old contents are dropped """
+    table = versions_table()
+    table.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        updated = connection.execute(table.update().where(table.c.name == name)
+                                     .values(version=table.c.version + 1))
+        if updated.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1))
+
+def create(engine, name):
+    """ Create the video table and any of its columns or indexes that don't exist yet """
+    table = video_table(name)
+    table.create(engine, checkfirst=True)
+    inspector = sqlalchemy.inspect(engine)
+    existing = set(column['name'] for column in inspector.get_columns(name))
+    for column in table.columns:
+        if column.name not in existing:
+            ensure_column(engine, name, column.name, column.type.compile(engine.dialect))
+    existing = set(index['name'] for index in inspector.get_indexes(name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+    return table
+
+def coerce_columns(df):
+    """ Convert the typed columns of a video frame, bad values become nulls """
+    df = df.copy()
+    for c in INT_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors='coerce').round().astype('Int64')
+    for c in FLOAT_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors='coerce')
+    for c in DATE_COLUMNS:
+        if c in df.columns:
+            # youtube-dl's YYYYMMDD, or dates already written out as YYYY-MM-DD
+            dates = pd.to_datetime(df[c].astype(str), format='%Y%m%d', errors='coerce')
+            dates = dates.fillna(pd.to_datetime(df[c], errors='coerce'))
+            df[c] = dates.dt.date
+
+    return df
+
+def is_typed(engine, name):
+    """ Whether an existing video table already has the typed schema """
+    columns = dict((c['name'], c['type']) for c in sqlalchemy.inspect(engine).get_columns(name))
+
+    return all(isinstance(columns.get(c), (sqlalchemy.Integer, sqlalchemy.Float, sqlalchemy.Date))
+               for c in INT_COLUMNS + FLOAT_COLUMNS + DATE_COLUMNS if c in columns)
+
+def id_ranges(engine, name, chunksize):
+    """ (first, last) ids of consecutive runs of chunksize distinct ids in a table
+
+    Each run's ids are read before it is yielded, so no cursor on the table is
+    left open while the caller writes. Rows with no id are left out.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    query = 'SELECT DISTINCT id FROM %s WHERE id %%s ORDER BY id LIMIT :n' % quote(name)
+    first = sqlalchemy.text(query % 'IS NOT NULL')
+    after = sqlalchemy.text(query % '> :last')
+    last = None
+    while True:
+        with engine.connect() as connection:
+            if last is None:
+                ids = [row[0] for row in connection.execute(first, {'n': chunksize})]
+            else:
+                ids = [row[0] for row in connection.execute(after, {'n': chunksize, 'last': last})]
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last = ids[-1]
+
+def migrate(engine, name, chunksize=50000):
+    """ Move an existing video table onto the typed schema
+
+    Rows are copied in chunks of ids into a new table, duplicate ids keep the
+    last row, and the new table then takes the old one's name. Every row of an
+    id is in the same chunk, and each chunk is read in full before it is
+    written, since SQLite can't write while a read is open on the file.
+    Indexes are built once all rows are in. The top tags and the <name>_tags
+    postings are filled in as rows are copied.
+    """
+    if not has_table(engine, name):
+        create(engine, name)
+        print('Created %s' % name)
+        return
+    if is_typed(engine, name):
+        create(engine, name)
+        print('%s is already typed' % name)
+        return
+
+    new_name = name + '_typed'
+    new_table = video_table(new_name, indexes=False)
+    new_table.drop(engine, checkfirst=True)
+    new_table.create(engine)
+    columns = set(c.name for c in new_table.columns)
+
+    quote = engine.dialect.identifier_preparer.quote
+    rows = sqlalchemy.text('SELECT * FROM %s WHERE id >= :first AND id <= :last' % quote(name))
+    loader = BulkLoader(engine, new_name, chunksize, key='id')
+    for first, last in id_ranges(engine, name, chunksize):
+        chunk = pd.read_sql(rows, engine, params={'first': first, 'last': last})
+        chunk = chunk[[c for c in chunk.columns if c in columns]].drop_duplicates('id', keep='last')
+        chunk['top_tags'] = chunk['tags'].map(normalize_tags)
+        loader.add(coerce_columns(chunk))
+        loader.flush()
+        load_tags(engine, name + '_tags', chunk, chunksize)
+    loader.close()
+
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text('DROP TABLE %s' % quote(name)))
+        connection.execute(sqlalchemy.text('ALTER TABLE %s RENAME TO %s' % (quote(new_name), quote(name))))
+    create(engine, name)
+    print('Migrated %d video(s) into the typed %s' % (loader.rows_written, name))
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Create or migrate the typed video table')
+    parser.add_argument('command', choices=['create', 'migrate'])
+    parser.add_argument('--database', '-d', help='Name of database, or a SQLAlchemy URL', required=True)
+    parser.add_argument('--table', '-t', help='Table of video information', required=True)
+    parser.add_argument('--user', '-u', help='Username for database connection (unless --database is a URL)')
+    parser.add_argument('--chunksize', type=int, default=50000, help='Rows copied per transaction by migrate')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    engine = create_engine(db_url(args.database, args.user))
+
+    if args.command == 'create':
+        if has_table(engine, args.table) and not is_typed(engine, args.table):
+            raise SystemExit('%s has untyped columns, run migrate instead' % args.table)
+        create(engine, args.table)
+    else:
+        migrate(engine, args.table, args.chunksize)
+
+if __name__ == '__main__':
+    main()